@@ -0,0 +1,235 @@
+"""
+Micro-benchmarks for the hot paths of the settlement generator.
+
+Every benchmark runs on seeded synthetic terrain (local_world.terrain_heights) at sizes from 64x64 to
+1024x1024, the schematic benchmarks run on every file in the Schematics directory. For each case the
+wall time (best and mean of --repeat runs) and the allocations of one extra traced run (peak traced
+memory and number of allocated blocks still alive at the peak) are recorded. A scaling exponent is
+fitted per benchmark: time ~ cells ** exponent, so 1.0 is linear in the area.
+
+Results are written as JSON, pass an earlier result file to --compare to print the speedup per case.
+    python benchmarks.py --sizes 64 128 256 --output bench.json
+    python benchmarks.py --compare bench.json
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import time
+import tracemalloc
+
+import numpy as np
+from glm import ivec3
+
+from biome import BiomeMap
+from local_world import LocalEditor, generate_world, terrain_heights
+from roads import astar
+from schematics import build_structure, load_rotated_schematic, read_schematic_from_file
+from schematic_format import load_schematic
+from settler import (BuildingPlot, compare_settlement_search, filter_overlapping_plots, find_building_locations,
+                     find_settlement_location)
+
+SIZES = (64, 128, 256, 512, 1024)
+SEA_LEVEL = 62
+
+
+def synthetic_terrain(size, seed):
+    """
+    Heightmap and water map of a size x size area, same terrain as the local world generator
+    :param size: side length of the area
+    :param seed: random seed
+    :return tuple: (heightmap, water_array), water_array is 1 where the top block is water
+    """
+    heightmap = terrain_heights(np.random.default_rng(seed), (size, size), SEA_LEVEL)
+    water_array = (heightmap < SEA_LEVEL).astype(heightmap.dtype)
+    heightmap = np.maximum(heightmap, SEA_LEVEL)
+    return heightmap, water_array
+
+
+def measure(function, repeat):
+    """
+    Times a function and traces its allocations, output printed by the function is discarded
+    :param function: callable without arguments
+    :param repeat: number of timed runs
+    :return dict: best and mean seconds, peak traced bytes and allocated blocks at the peak
+    """
+    times = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(repeat):
+            start = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - start)
+
+        # Tracing slows everything down, so allocations come from a separate run
+        tracemalloc.start()
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+        blocks = sum(stat.count for stat in tracemalloc.take_snapshot().statistics("filename"))
+        tracemalloc.stop()
+
+    return {"best": min(times), "mean": sum(times) / len(times), "peak_bytes": peak, "blocks": blocks}
+
+
+def settlement_cases(size, seed):
+    # find_settlement_location over the whole area, find_building_locations inside the chosen plot
+    heightmap, water_array = synthetic_terrain(size, seed)
+    begin = ivec3(0, 0, 0)
+    biome_map = BiomeMap(["minecraft:plains"], np.zeros(heightmap.shape, dtype=np.int32), 0, 0)
+    with contextlib.redirect_stdout(io.StringIO()):
+        settlement_plot, settlement_water, negative, _ = find_settlement_location(begin, water_array, heightmap)
+
+    yield "find_settlement_location", lambda: find_settlement_location(begin, water_array, heightmap)
+    yield "find_settlement_location_pyramid", lambda: find_settlement_location(begin, water_array, heightmap,
+                                                                                pyramid_levels=3)
+    yield "find_building_locations", lambda: find_building_locations(None, settlement_plot, settlement_water,
+                                                                     negative, biome_map)
+
+
+def overlap_cases(size, seed):
+    # filter_overlapping_plots on one candidate 9x9 plot per 16 columns, sorted like the settler does
+    rng = np.random.default_rng(seed)
+    count = size * size // 16
+    plot = np.zeros((9, 9), dtype=np.int64)
+    plots = sorted(BuildingPlot(plot, int(x), int(z), float(std)) for x, z, std in
+                   zip(rng.integers(0, size - 9, count), rng.integers(0, size - 9, count), rng.random(count)))
+
+    yield "filter_overlapping_plots", lambda: filter_overlapping_plots(plots, 3)
+
+
+def road_cases(size, seed):
+    # astar between opposite corners, with a scatter of 9x9 buildings as obstacles
+    heightmap, _ = synthetic_terrain(size, seed)
+    rng = np.random.default_rng(seed)
+    obstacles = np.zeros(heightmap.shape, dtype=bool)
+    for x, z in zip(rng.integers(8, size - 16, size // 8), rng.integers(8, size - 16, size // 8)):
+        obstacles[x: x + 9, z: z + 9] = True
+    obstacles[:4, :4] = obstacles[-4:, -4:] = False
+    first = ivec3(1, int(heightmap[1, 1]) - 1, 1)
+    goal = ivec3(size - 2, int(heightmap[size - 2, size - 2]) - 1, size - 2)
+
+    yield "astar", lambda: astar(heightmap, (0, 0, 0), first, goal, obstacles)
+
+
+def schematic_cases(directory, seed):
+    # Reading and building every schematic, building goes to an in-memory world
+    world = generate_world(32, seed, trees=False)
+    editor = LocalEditor(world)
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if not name.endswith(".txt"):
+            # Only the text format is read by the generator
+            continue
+        plot = BuildingPlot(np.full((9, 9), 100), 8, 8, 0.0)
+        plot.schematic_path = path
+
+        def build(bulk, plot=plot, path=path):
+            # A cold cache, so loading and rotating are part of the measurement
+            load_rotated_schematic.cache_clear()
+            build_structure(editor, plot, bulk=bulk)
+
+        yield name, "read_schematic_from_file", lambda path=path: read_schematic_from_file(path)
+        yield name, "load_schematic", lambda path=path: load_schematic(path)
+        yield name, "build_structure", lambda build=build: build(False)
+        yield name, "build_structure_bulk", lambda build=build: build(True)
+
+
+def scaling_exponents(results):
+    """
+    Fits time ~ cells ** exponent for every benchmark that ran at more than one size
+    :param results: list of result dicts with "name", "size" and "best"
+    :return dict: benchmark name to exponent
+    """
+    exponents = {}
+    for name in sorted({result["name"] for result in results if "size" in result}):
+        points = [(result["size"] ** 2, result["best"]) for result in results
+                  if result["name"] == name and "size" in result and result["best"] > 0]
+        if len(points) > 1:
+            cells, seconds = np.log(np.array(points)).T
+            exponents[name] = float(np.polyfit(cells, seconds, 1)[0])
+    return exponents
+
+
+def run(sizes, repeat, seed, directory):
+    """
+    Runs all benchmarks
+    :return dict: metadata, per case results and scaling exponents, ready to be written as JSON
+    """
+    results = []
+    for size in sizes:
+        for cases in (settlement_cases, overlap_cases, road_cases):
+            for name, function in cases(size, seed):
+                result = {"name": name, "size": size, **measure(function, repeat)}
+                results.append(result)
+                print(f"{name:<34} {size:>5}  {result['best'] * 1000:10.2f} ms  "
+                      f"{result['peak_bytes'] / 1024:10.1f} KiB peak")
+
+    for schematic, name, function in schematic_cases(directory, seed):
+        result = {"name": name, "schematic": schematic, **measure(function, repeat)}
+        results.append(result)
+        print(f"{name:<34} {schematic:<26} {result['best'] * 1000:10.2f} ms  "
+              f"{result['peak_bytes'] / 1024:10.1f} KiB peak")
+
+    # How far the pyramid search ends up from the exhaustive answer
+    pyramid = []
+    for size in sizes:
+        heightmap, water_array = synthetic_terrain(size, seed)
+        report = compare_settlement_search(heightmap, water_array, levels=3)
+        pyramid.append({"size": size, "std_error": report["std_error"], "distance": report["distance"]})
+        print(f"{'pyramid accuracy':<34} {size:>5}  std {report['std_error']:+.4f}  "
+              f"offset distance {report['distance']:.1f}")
+
+    exponents = scaling_exponents(results)
+    for name, exponent in exponents.items():
+        print(f"{name:<34} time ~ cells^{exponent:.2f}")
+
+    return {
+        "meta": {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+                 "numpy": np.__version__, "machine": platform.machine(), "seed": seed, "repeat": repeat,
+                 "sizes": list(sizes)},
+        "results": results,
+        "scaling": exponents,
+        "pyramid_accuracy": pyramid,
+    }
+
+
+def case_key(result):
+    return result["name"], result.get("size"), result.get("schematic")
+
+
+def compare(report, baseline):
+    # Prints the speedup of every case found in both reports, > 1 means faster than the baseline
+    previous = {case_key(result): result for result in baseline["results"]}
+    for result in report["results"]:
+        old = previous.get(case_key(result))
+        if old is None or result["best"] == 0:
+            continue
+        label = result.get("schematic", result.get("size"))
+        print(f"{result['name']:<34} {label!s:<26} {old['best'] / result['best']:6.2f}x  "
+              f"peak {old['peak_bytes'] / 1024:.1f} -> {result['peak_bytes'] / 1024:.1f} KiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the settler, roads and schematics hot paths")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="side lengths of the synthetic areas")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per case, the best one is reported")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic terrain")
+    parser.add_argument("--schematics", default="Schematics", help="directory of schematics to benchmark")
+    parser.add_argument("--output", default="bench_output.json", help="JSON file to write the results to")
+    parser.add_argument("--compare", metavar="JSON", help="earlier results to compare against")
+    args = parser.parse_args()
+
+    report = run(args.sizes, args.repeat, args.seed, args.schematics)
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare, 'r') as file:
+            compare(report, json.load(file))
+
+
+if __name__ == "__main__":
+    main()
@@ -10,67 +10,110 @@ from gdpc.vector_tools import addY
 from collections import Counter
 import operator
 
+import numpy as np
+
+from world_layers import surface_biomes
+
 biomes_dict = {
-    "minecraft:badlands": "Schematics\\badlands_house.txt",
-    "minecraft:bamboo_jungle": "Schematics\\jungle_house.txt",
-    "minecraft:beach": "Schematics\\sand_house.txt",
-    "minecraft:birch_forest": "Schematics\\birch_house.txt",
-    "minecraft:cherry_grove": "Schematics\\cherry_house.txt",
+    "minecraft:badlands": "Schematics/badlands_house.txt",
+    "minecraft:bamboo_jungle": "Schematics/jungle_house.txt",
+    "minecraft:beach": "Schematics/sand_house.txt",
+    "minecraft:birch_forest": "Schematics/birch_house.txt",
+    "minecraft:cherry_grove": "Schematics/cherry_house.txt",
     "minecraft:cold_ocean": None,
-    "minecraft:dark_forest": "Schematics\\mushroom_house.txt",
+    "minecraft:dark_forest": "Schematics/mushroom_house.txt",
     "minecraft:deep_cold_ocean": None,
     "minecraft:deep_dark": None,
-    "minecraft:deep_frozen_ocean": "Schematics\\ice_spike_house.txt",
+    "minecraft:deep_frozen_ocean": "Schematics/ice_spike_house.txt",
     "minecraft:deep_lukewarm_ocean": None,
     "minecraft:deep_ocean": None,
-    "minecraft:desert": "Schematics\\sand_house.txt",
+    "minecraft:desert": "Schematics/sand_house.txt",
     "minecraft:dripstone_caves": None,
-    "minecraft:eroded_badlands": "Schematics\\badlands_house.txt",
-    "minecraft:flower_forest": "Schematics\\oak_house.txt",
-    "minecraft:forest": "Schematics\\oak_house.txt",
-    "minecraft:frozen_ocean": "Schematics\\ice_spike_house.txt",
-    "minecraft:frozen_peaks": "Schematics\\igloo.txt",
-    "minecraft:frozen_river": "Schematics\\ice_spike_house.txt",
-    "minecraft:grove": "Schematics\\igloo.txt",
-    "minecraft:ice_spikes": "Schematics\\ice_spike_house.txt",
-    "minecraft:jagged_peaks": "Schematics\\igloo.txt",
-    "minecraft:jungle": "Schematics\\jungle_house.txt",
+    "minecraft:eroded_badlands": "Schematics/badlands_house.txt",
+    "minecraft:flower_forest": "Schematics/oak_house.txt",
+    "minecraft:forest": "Schematics/oak_house.txt",
+    "minecraft:frozen_ocean": "Schematics/ice_spike_house.txt",
+    "minecraft:frozen_peaks": "Schematics/igloo.txt",
+    "minecraft:frozen_river": "Schematics/ice_spike_house.txt",
+    "minecraft:grove": "Schematics/igloo.txt",
+    "minecraft:ice_spikes": "Schematics/ice_spike_house.txt",
+    "minecraft:jagged_peaks": "Schematics/igloo.txt",
+    "minecraft:jungle": "Schematics/jungle_house.txt",
     "minecraft:lukewarm_ocean": None,
     "minecraft:lush_caves": None,
-    "minecraft:mangrove_swamp": "Schematics\\mangrove_house.txt",
-    "minecraft:meadow": "Schematics\\oak_house.txt",
-    "minecraft:mushroom_fields": "Schematics\\mushroom_house.txt",
+    "minecraft:mangrove_swamp": "Schematics/mangrove_house.txt",
+    "minecraft:meadow": "Schematics/oak_house.txt",
+    "minecraft:mushroom_fields": "Schematics/mushroom_house.txt",
     "minecraft:ocean": None,
-    "minecraft:old_growth_birch_forest": "Schematics\\birch_house.txt",
-    "minecraft:old_growth_pine_taiga": "Schematics\\spruce_house.txt",
-    "minecraft:old_growth_spruce_taiga": "Schematics\\spruce_house.txt",
-    "minecraft:plains": "Schematics\\oak_house.txt",
-    "minecraft:river": "Schematics\\oak_house.txt",
-    "minecraft:savanna": "Schematics\\acacia_house.txt",
-    "minecraft:savanna_plateau": "Schematics\\acacia_house.txt",
-    "minecraft:snowy_beach": "Schematics\\snowy_beach_house.txt",
-    "minecraft:snowy_plains": "Schematics\\igloo.txt",
-    "minecraft:snowy_slopes": "Schematics\\igloo.txt",
-    "minecraft:snowy_taiga": "Schematics\\spruce_house.txt",
-    "minecraft:sparse_jungle": "Schematics\\jungle_house.txt",
-    "minecraft:stony_peaks": "Schematics\\stone_house.txt",
-    "minecraft:stony_shore": "Schematics\\stone_house.txt",
-    "minecraft:sunflower_plains": "Schematics\\oak_house.txt",
-    "minecraft:swamp": "Schematics\\swamp_house.txt",
-    "minecraft:taiga": "Schematics\\spruce_house.txt",
+    "minecraft:old_growth_birch_forest": "Schematics/birch_house.txt",
+    "minecraft:old_growth_pine_taiga": "Schematics/spruce_house.txt",
+    "minecraft:old_growth_spruce_taiga": "Schematics/spruce_house.txt",
+    "minecraft:plains": "Schematics/oak_house.txt",
+    "minecraft:river": "Schematics/oak_house.txt",
+    "minecraft:savanna": "Schematics/acacia_house.txt",
+    "minecraft:savanna_plateau": "Schematics/acacia_house.txt",
+    "minecraft:snowy_beach": "Schematics/snowy_beach_house.txt",
+    "minecraft:snowy_plains": "Schematics/igloo.txt",
+    "minecraft:snowy_slopes": "Schematics/igloo.txt",
+    "minecraft:snowy_taiga": "Schematics/spruce_house.txt",
+    "minecraft:sparse_jungle": "Schematics/jungle_house.txt",
+    "minecraft:stony_peaks": "Schematics/stone_house.txt",
+    "minecraft:stony_shore": "Schematics/stone_house.txt",
+    "minecraft:sunflower_plains": "Schematics/oak_house.txt",
+    "minecraft:swamp": "Schematics/swamp_house.txt",
+    "minecraft:taiga": "Schematics/spruce_house.txt",
     "minecraft:warm_ocean": None,
-    "minecraft:windswept_forest": "Schematics\\spruce_house.txt",
-    "minecraft:windswept_gravelly_hills": "Schematics\\spruce_house.txt",
-    "minecraft:windswept_hills": "Schematics\\spruce_house.txt",
-    "minecraft:windswept_savanna": "Schematics\\acacia_house.txt",
-    "minecraft:wooded_badlands": "Schematics\\wooded_badlands_house.txt"
+    "minecraft:windswept_forest": "Schematics/spruce_house.txt",
+    "minecraft:windswept_gravelly_hills": "Schematics/spruce_house.txt",
+    "minecraft:windswept_hills": "Schematics/spruce_house.txt",
+    "minecraft:windswept_savanna": "Schematics/acacia_house.txt",
+    "minecraft:wooded_badlands": "Schematics/wooded_badlands_house.txt"
 }
 
+class BiomeMap:
+    """Surface biome of every column of an area, read from a WorldSlice in one pass"""
+
+    def __init__(self, palette, ids, begin_x, begin_z):
+        self.palette = palette
+        self.ids = ids
+        self.begin_x = begin_x
+        self.begin_z = begin_z
+
+    def majority(self, x, z, size_x, size_z):
+        # Most common biome over the footprint starting at global (x, z)
+        window = self.ids[max(x - self.begin_x, 0): max(x - self.begin_x + size_x, 0),
+                          max(z - self.begin_z, 0): max(z - self.begin_z + size_z, 0)]
+        return self._most_common(window)
+
+    def most_common(self):
+        # Most common biome over the whole area
+        return self._most_common(self.ids)
+
+    def _most_common(self, ids):
+        ids = ids[ids >= 0]
+        if ids.size == 0:
+            return None
+        return self.palette[int(np.argmax(np.bincount(ids, minlength=len(self.palette))))]
+
+
+def load_biome_map(world_slice, heightmap):
+    """
+    Builds the biome map of a loaded WorldSlice
+    :param world_slice: loaded gdpc WorldSlice
+    :param heightmap: heightmap of the slice, biomes are read at the top block of every column
+    :return BiomeMap:
+    """
+    palette, ids = surface_biomes(world_slice, heightmap)
+    return BiomeMap(palette, ids, world_slice.rect.offset.x, world_slice.rect.offset.y)
+
+
 # Returns the most common biome within the set build area
-def check_biome(editor):
-    buildArea = editor.getBuildArea()
-    print(type(buildArea.center), buildArea.center)
-    return editor.getBiome(buildArea.center)
+def check_biome(editor, biome_map=None):
+    if biome_map is None:
+        buildArea = editor.getBuildArea()
+        worldSlice = editor.loadWorldSlice(buildArea.toRect())
+        biome_map = load_biome_map(worldSlice, worldSlice.heightmaps["MOTION_BLOCKING_NO_LEAVES"])
+    return biome_map.most_common()
                 
 
 def main():
@@ -0,0 +1,220 @@
+"""
+BuildPlan: every placement stage writes into one plan, which is sent to the world in a single flush.
+
+A BuildPlan stands in for the editor during foundations, structures, roads and outlines. Placed blocks
+and fill/setblock commands are stored per position in sparse numpy sections instead of being sent.
+When two writes hit the same position, the one with the higher priority wins, and for equal
+priorities the later one wins. Priorities are set per stage with BuildPlan.priority.
+
+flush() then sends only the final block of every position. It goes one region of 4x4 chunks at a time:
+identical blocks are merged into fill commands with schematics.merge_regions, and the remaining
+blocks are placed grouped by block, bottom layer first. A dry run returns the same counts without
+sending anything.
+
+Placements with a replace filter and commands other than plain fill and setblock depend on the world
+at the time they run. They are not stored per position and are sent after the blocks, in order.
+"""
+
+import random
+from collections import Counter
+from contextlib import contextmanager
+
+import numpy as np
+from gdpc import Block, Transform
+from gdpc.block import transformedBlockOrPalette
+from glm import ivec3
+
+from placement_pipeline import is_single_position
+from schematics import COMMAND_BATCH_SIZE, MIN_FILL_VOLUME, fill_command, run_commands, split_regions
+from world_layers import block_from_state
+from write_diff import FILL, SECTION, SETBLOCK, UNKNOWN, VoxelSections, state_key
+
+# Side length in chunks of the regions whose blocks are merged into fills together
+REGION_SECTIONS = 4
+# Priority of a position nothing has been written to
+NO_PRIORITY = np.iinfo(np.int32).min
+
+
+class BuildPlan:
+    """Editor stand-in that records placements and sends the resolved result in one flush"""
+
+    def __init__(self, transform=None):
+        """
+        :param transform: gdpc Transform that local positions are placed through, identity by default
+        """
+        self.transform = transform if transform is not None else Transform()
+        self.blocks = VoxelSections()
+        self.priorities = VoxelSections(NO_PRIORITY)
+        self.palette = []  # Block of every palette index
+        self.palette_ids = {}
+        self.deferred = []  # (method, args) sent after the blocks, in order
+        self.current_priority = 0
+
+        # Statistics: block writes recorded and writes that were lost to a later or higher priority write
+        self.writes = 0
+        self.overwritten = 0
+        self.rejected = 0
+
+    # Stages call these like they would on an editor, buffering is reported as on so place_volume flushes here
+    buffering = True
+
+    def flushBuffer(self):
+        pass
+
+    def awaitBufferFlushes(self, timeout=None):
+        pass
+
+    @contextmanager
+    def priority(self, value):
+        """
+        Writes made inside the context use this priority. A position keeps the block of its highest
+        priority write, the latest one among equals
+        :param value: integer priority, 0 outside of any context
+        """
+        previous, self.current_priority = self.current_priority, value
+        try:
+            yield self
+        finally:
+            self.current_priority = previous
+
+    def placeBlock(self, position, block, replace=None):
+        positions = [position] if is_single_position(position) else list(position)
+        global_block = transformedBlockOrPalette(block, self.transform.rotation, self.transform.flip)
+        return self.placeBlockGlobal([self.transform * local for local in positions], global_block, replace)
+
+    def placeBlockGlobal(self, position, block, replace=None):
+        positions = [position] if is_single_position(position) else list(position)
+        if replace is not None:
+            self.deferred.append(("placeBlockGlobal", (positions, block, replace)))
+            return True
+        for x, y, z in positions:
+            # Like gdpc, a sequence of blocks is sampled per position
+            placed = block if isinstance(block, Block) else random.choice(block)
+            self._write_position(int(x), int(y), int(z), self._palette_id(placed))
+        return True
+
+    def runCommand(self, command, position=None, syncWithBuffer=False):
+        for line in command.split("\n"):
+            stripped = line.strip()
+            match = FILL.match(stripped)
+            if match is not None and (match.group(8) in (None, "destroy") or
+                                      (match.group(8) == "replace" and not match.group(9))):
+                coordinates = [int(value) for value in match.group(1, 2, 3, 4, 5, 6)]
+                begin = [min(coordinates[i], coordinates[i + 3]) for i in range(3)]
+                end = [max(coordinates[i], coordinates[i + 3]) + 1 for i in range(3)]
+                self._write_box(begin, end, self._palette_id(block_from_state(match.group(7))))
+                continue
+            match = SETBLOCK.match(stripped)
+            if match is not None and match.group(5) in (None, "replace", "destroy"):
+                x, y, z = (int(value) for value in match.group(1, 2, 3))
+                self._write_box((x, y, z), (x + 1, y + 1, z + 1), self._palette_id(block_from_state(match.group(4))))
+                continue
+            if stripped:
+                self.deferred.append(("runCommand", (line, position)))
+
+    def _palette_id(self, block):
+        key = state_key(str(block))
+        value = self.palette_ids.get(key)
+        if value is None:
+            value = self.palette_ids[key] = len(self.palette)
+            self.palette.append(block)
+        return value
+
+    def _write_position(self, x, y, z, value):
+        # _write_box for a single position, without the section windows
+        key, index = (x >> 4, y >> 4, z >> 4), (x & 15, y & 15, z & 15)
+        blocks, priorities = self.blocks.section(*key), self.priorities.section(*key)
+        self.writes += 1
+        if priorities[index] > self.current_priority:
+            self.rejected += 1
+            return
+        if blocks[index] != UNKNOWN:
+            self.overwritten += 1
+        blocks[index] = value
+        priorities[index] = self.current_priority
+
+    def _write_box(self, begin, end, value):
+        # Writes value to every position of the box whose current priority is not higher
+        priority = self.current_priority
+        for key, window in VoxelSections.windows(begin, end):
+            blocks = self.blocks.section(*key)[window]
+            priorities = self.priorities.section(*key)[window]
+            accepted = priorities <= priority
+            self.writes += blocks.size
+            self.rejected += blocks.size - int(accepted.sum())
+            self.overwritten += int((accepted & (blocks != UNKNOWN)).sum())
+            blocks[accepted] = value
+            priorities[accepted] = priority
+
+    def regions(self, region_sections=REGION_SECTIONS):
+        """
+        Dense palette indices of every group of region_sections x region_sections chunk columns that
+        holds blocks, in order of their position
+        :param region_sections: side length of a region in chunks
+        :return generator: (origin, indices) with origin the ivec3 of indices[0, 0, 0] and UNKNOWN where
+            nothing is placed
+        """
+        region_keys = {}
+        for key in self.blocks.sections:
+            region_keys.setdefault((key[0] // region_sections, key[2] // region_sections), []).append(key)
+        for rx, rz in sorted(region_keys):
+            keys = region_keys[rx, rz]
+            low = min(sy for _, sy, _ in keys)
+            high = max(sy for _, sy, _ in keys) + 1
+            origin = ivec3(rx * region_sections, low, rz * region_sections) * SECTION
+            side = region_sections * SECTION
+            indices = np.full((side, (high - low) * SECTION, side), UNKNOWN, dtype=np.int32)
+            for sx, sy, sz in keys:
+                i, j, k = sx * SECTION - origin.x, sy * SECTION - origin.y, sz * SECTION - origin.z
+                indices[i:i + SECTION, j:j + SECTION, k:k + SECTION] = self.blocks.sections[sx, sy, sz]
+            yield origin, indices
+
+    def flush(self, editor=None, dry_run=False, min_fill_volume=MIN_FILL_VOLUME):
+        """
+        Sends the final block of every position. Boxes of identical blocks become fill commands,
+        the rest is placed grouped by block, bottom layer first, one region of chunks at a time
+        :param editor: editor (or PlacementPipeline, WriteDiffer) to send to, not needed for a dry run
+        :param dry_run: only count what would be sent
+        :param min_fill_volume: smallest box that is sent as a fill command
+        :return dict: blocks, fill regions, blocks covered by fills, single placements, deferred writes,
+            overwritten writes and the number of blocks per block type
+        """
+        fill_lines = []
+        fill_regions = filled_blocks = single_blocks = 0
+        counts = Counter()
+
+        for origin, indices in self.regions():
+            solid = indices != UNKNOWN
+            values, value_counts = np.unique(indices[solid], return_counts=True)
+            counts.update({str(self.palette[value]): int(count) for value, count in zip(values, value_counts)})
+
+            fills, singles = split_regions(indices, solid, lambda i, j, k: origin + ivec3(i, j, k), min_fill_volume)
+            fill_regions += len(fills)
+            for corner1, corner2, value in fills:
+                filled_blocks += (corner2.x - corner1.x + 1) * (corner2.y - corner1.y + 1) * (corner2.z - corner1.z + 1)
+                fill_lines.append(fill_command(corner1, corner2, self.palette[value]))
+
+            if dry_run:
+                single_blocks += sum(len(positions) for layer in singles.values() for positions in layer.values())
+                continue
+            # Fills of a region go out before its single blocks, which may rest on them
+            if len(fill_lines) >= COMMAND_BATCH_SIZE or singles:
+                run_commands(editor, fill_lines)
+                fill_lines.clear()
+            for layer in sorted(singles):
+                for value, positions in singles[layer].items():
+                    editor.placeBlockGlobal(positions, self.palette[value])
+                    single_blocks += len(positions)
+
+        if not dry_run:
+            run_commands(editor, fill_lines)
+            for method, args in self.deferred:
+                getattr(editor, method)(*args)
+
+        summary = {"blocks": filled_blocks + single_blocks, "fill_regions": fill_regions,
+                   "filled_blocks": filled_blocks, "single_blocks": single_blocks, "deferred": len(self.deferred),
+                   "writes": self.writes, "overwritten": self.overwritten, "rejected": self.rejected,
+                   "block_counts": dict(counts.most_common())}
+        print(f"{'Planned' if dry_run else 'Sent'} {summary['blocks']} blocks: {fill_regions} fill regions covering "
+              f"{filled_blocks} blocks, {single_blocks} single blocks, {len(self.deferred)} deferred writes")
+        return summary
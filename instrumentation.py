@@ -0,0 +1,167 @@
+"""
+Per-stage instrumentation of the generator: wall time, HTTP requests, blocks placed and peak memory.
+
+Requests and blocks are counted where they leave the process. For a gdpc Editor the GDMC-HTTP
+interface functions are wrapped while profiling is on. A LocalEditor keeps its own counters. With a
+buffering editor, blocks count towards the stage that flushes them, not the stage that placed them.
+
+A disabled profiler hands out a shared no-op context manager, so the stages in main.py cost nothing
+when profiling is off.
+"""
+
+import contextlib
+import json
+import time
+import tracemalloc
+
+from gdpc import interface
+
+
+class InterfaceCounter:
+    """Counts requests and placed blocks by wrapping the gdpc interface functions"""
+
+    def __init__(self):
+        self.requests = 0
+        self.blocks_placed = 0
+        self._originals = None
+
+    def install(self):
+        if self._originals is not None:
+            return
+        self._originals = {name: getattr(interface, name) for name in ("_request", "placeBlocks", "runCommand")}
+        request, place_blocks, run_command = (self._originals[name]
+                                              for name in ("_request", "placeBlocks", "runCommand"))
+
+        def counted_request(*args, **kwargs):
+            self.requests += 1
+            return request(*args, **kwargs)
+
+        def counted_place_blocks(blocks, *args, **kwargs):
+            blocks = list(blocks)
+            self.blocks_placed += len(blocks)
+            return place_blocks(blocks, *args, **kwargs)
+
+        def counted_run_command(command, *args, **kwargs):
+            self.blocks_placed += command_blocks(command)
+            return run_command(command, *args, **kwargs)
+
+        interface._request = counted_request
+        interface.placeBlocks = counted_place_blocks
+        interface.runCommand = counted_run_command
+
+    def uninstall(self):
+        if self._originals is None:
+            return
+        for name, function in self._originals.items():
+            setattr(interface, name, function)
+        self._originals = None
+
+
+def command_blocks(command):
+    """
+    Number of blocks changed by the fill and setblock commands in a newline separated command string
+    :param command: commands as sent to runCommand
+    :return int: blocks, every fill counts its full volume
+    """
+    blocks = 0
+    for line in command.split("\n"):
+        words = line.strip().lstrip("/").split(" ")
+        if words[0] == "setblock":
+            blocks += 1
+        elif words[0] == "fill" and len(words) >= 7:
+            corners = list(map(int, words[1:7]))
+            blocks += ((abs(corners[3] - corners[0]) + 1) * (abs(corners[4] - corners[1]) + 1)
+                       * (abs(corners[5] - corners[2]) + 1))
+    return blocks
+
+
+class StageProfiler:
+    """Records one entry per named stage of the pipeline"""
+
+    def __init__(self, editor=None, enabled=True, trace_memory=True):
+        """
+        :param editor: editor whose traffic is measured, a LocalEditor is read through its own counters
+        :param enabled: when False, stage() does nothing and nothing is recorded
+        :param trace_memory: record peak memory per stage with tracemalloc, which slows Python allocations down
+        """
+        self.enabled = enabled
+        self.trace_memory = trace_memory
+        self.stages = []
+        self._editor = editor
+        self._counter = None
+        if enabled and not hasattr(editor, "blocks_placed"):
+            self._counter = InterfaceCounter()
+            self._counter.install()
+        if enabled and trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def _counts(self):
+        source = self._counter if self._counter is not None else self._editor
+        if source is None:
+            return 0, 0
+        return source.requests, source.blocks_placed
+
+    def stage(self, name):
+        """
+        Context manager measuring everything that runs inside it as one stage
+        :param name: stage name shown in the summary
+        """
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self._measure(name)
+
+    @contextlib.contextmanager
+    def _measure(self, name):
+        requests, blocks = self._counts()
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            memory, _ = tracemalloc.get_traced_memory()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            end_requests, end_blocks = self._counts()
+            entry = {"stage": name, "seconds": seconds, "requests": end_requests - requests,
+                     "blocks": end_blocks - blocks}
+            if self.trace_memory:
+                # Peak above what was already allocated when the stage started
+                _, peak = tracemalloc.get_traced_memory()
+                entry["peak_bytes"] = max(peak - memory, 0)
+            self.stages.append(entry)
+
+    def summary(self):
+        # Readable table of all stages with totals
+        lines = [f"{'stage':<28} {'seconds':>9} {'requests':>9} {'blocks':>9}"
+                 + (f" {'peak MiB':>9}" if self.trace_memory else "")]
+        for entry in self.stages + [self.totals()]:
+            line = f"{entry['stage']:<28} {entry['seconds']:>9.3f} {entry['requests']:>9} {entry['blocks']:>9}"
+            if self.trace_memory:
+                line += f" {entry['peak_bytes'] / 2 ** 20:>9.1f}"
+            lines.append(line)
+        return "\n".join(lines)
+
+    def totals(self):
+        # Sums over all stages, the peak is the largest stage peak
+        totals = {"stage": "total", "seconds": sum(entry["seconds"] for entry in self.stages),
+                  "requests": sum(entry["requests"] for entry in self.stages),
+                  "blocks": sum(entry["blocks"] for entry in self.stages)}
+        if self.trace_memory:
+            totals["peak_bytes"] = max((entry["peak_bytes"] for entry in self.stages), default=0)
+        return totals
+
+    def write_trace(self, filename):
+        """
+        Writes all stages and the totals as JSON
+        :param filename: path of the trace file
+        """
+        with open(filename, 'w') as file:
+            json.dump({"stages": self.stages, "totals": self.totals()}, file, indent=2)
+
+    def close(self):
+        # Restores the wrapped interface functions and stops memory tracing
+        if self._counter is not None:
+            self._counter.uninstall()
+            self._counter = None
+        if self.enabled and self.trace_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
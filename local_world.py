@@ -0,0 +1,487 @@
+"""
+In-memory voxel world that stands in for a Minecraft server with GDMC-HTTP.
+
+LocalEditor implements the part of the gdpc Editor interface the pipeline uses (build area, world
+slices, getBlock/placeBlock, getBiome, fill/setblock commands and buffering) on top of numpy voxel,
+heightmap and biome arrays. generate_world builds seeded synthetic terrain of any size, so the whole
+pipeline can run and be profiled without a server.
+"""
+
+import random
+from numbers import Integral
+
+import numpy as np
+from gdpc import Block, Box, Rect
+from gdpc.transform import Transform
+from glm import ivec2, ivec3
+
+from world_layers import block_from_state
+
+# Blocks that do not count for the MOTION_BLOCKING heightmaps besides air
+NON_BLOCKING = ("grass", "short_grass", "tall_grass", "fern", "dandelion", "poppy", "azure_bluet", "oxeye_daisy",
+                "sugar_cane", "vine", "snow", "torch", "wall_torch", "dead_bush")
+AIR = ("minecraft:air", "minecraft:cave_air", "minecraft:void_air")
+
+# Biomes used for synthetic terrain, from cold to hot, all of them have a schematic in biomes_dict
+SYNTHETIC_BIOMES = ("minecraft:snowy_plains", "minecraft:taiga", "minecraft:forest", "minecraft:plains",
+                    "minecraft:savanna", "minecraft:desert")
+
+
+def normalize_state(state):
+    # Block state string with the minecraft: namespace added when it is missing
+    block_name = state.split("[", 1)[0].split("{", 1)[0]
+    return state if ":" in block_name else "minecraft:" + state
+
+
+class LocalSection:
+    """A 16x16x16 section of a LocalWorldSlice, same interface as world_layers.Section"""
+
+    def __init__(self, x, y, z, states, indices, biomes, biome_indices):
+        self.x = x
+        self.y = y
+        self.z = z
+        self.states = states
+        self.indices = indices
+        self.biomes = biomes
+        self.biome_indices = biome_indices
+
+
+class LocalWorld:
+    """Voxel storage of a chunk aligned area, blocks are palette indices indexed [x, y, z]"""
+
+    def __init__(self, offset, blocks, palette, biomes, biome_palette, build_area, y_begin=0):
+        self.offset = ivec2(*offset)  # chunk aligned (x, z) of blocks[0, :, 0]
+        self.y_begin = y_begin
+        self.blocks = blocks
+        self.palette = list(palette)
+        self.palette_ids = {state: i for i, state in enumerate(self.palette)}
+        self.biomes = biomes  # biome palette index per column, indexed [x, z]
+        self.biome_palette = list(biome_palette)
+        self.build_area = build_area
+
+    @property
+    def y_end(self):
+        return self.y_begin + self.blocks.shape[1]
+
+    def state_id(self, state):
+        # Palette index of a block state, new states are added to the palette
+        state = normalize_state(state)
+        index = self.palette_ids.get(state)
+        if index is None:
+            index = len(self.palette)
+            self.palette.append(state)
+            self.palette_ids[state] = index
+        return index
+
+    def local(self, position):
+        # Array index of a global position, None when it is outside the stored area
+        x = position[0] - self.offset.x
+        y = position[1] - self.y_begin
+        z = position[2] - self.offset.y
+        if 0 <= x < self.blocks.shape[0] and 0 <= y < self.blocks.shape[1] and 0 <= z < self.blocks.shape[2]:
+            return x, y, z
+        return None
+
+    def box_slices(self, first, last):
+        # Array slices of the box between two global corners (inclusive), clipped to the stored area
+        low = [min(a, b) for a, b in zip(first, last)]
+        high = [max(a, b) + 1 for a, b in zip(first, last)]
+        origin = (self.offset.x, self.y_begin, self.offset.y)
+        return tuple(slice(min(max(l - o, 0), size), min(max(h - o, 0), size))
+                     for l, h, o, size in zip(low, high, origin, self.blocks.shape))
+
+
+class LocalWorldSlice:
+    """Snapshot of a rect of a LocalWorld, offers the WorldSlice interface the pipeline uses"""
+
+    def __init__(self, world, rect, heightmapTypes=None):
+        self._rect = rect
+        self._chunkRect = Rect(rect.offset >> 4, ((rect.last >> 4) - (rect.offset >> 4)) + 1)
+        self._yBegin = world.y_begin
+        air = world.state_id("minecraft:air")
+        self._palette = list(world.palette)
+        self._biome_palette = list(world.biome_palette)
+
+        # Copy of the chunks covering the rect
+        begin = self._chunkRect.offset * 16 - world.offset
+        end = begin + self._chunkRect.size * 16
+        x_slice = slice(max(begin.x, 0), max(end.x, 0))
+        z_slice = slice(max(begin.y, 0), max(end.y, 0))
+        self._blocks = np.full((self._chunkRect.size.x * 16, world.blocks.shape[1], self._chunkRect.size.y * 16),
+                               air, dtype=world.blocks.dtype)
+        self._biomes = np.zeros((self._chunkRect.size.x * 16, self._chunkRect.size.y * 16), dtype=world.biomes.dtype)
+        target = (slice(x_slice.start - begin.x, x_slice.stop - begin.x), slice(None),
+                  slice(z_slice.start - begin.y, z_slice.stop - begin.y))
+        self._blocks[target] = world.blocks[x_slice, :, z_slice]
+        self._biomes[target[0], target[2]] = world.biomes[x_slice, z_slice]
+
+        if heightmapTypes is None:
+            heightmapTypes = ("WORLD_SURFACE", "OCEAN_FLOOR", "MOTION_BLOCKING", "MOTION_BLOCKING_NO_LEAVES")
+        self._heightmaps = {name: self._heightmap(name) for name in heightmapTypes}
+
+    def __repr__(self):
+        return f"LocalWorldSlice{repr(self._rect)}"
+
+    def _heightmap(self, name):
+        # Height above the highest block that counts for this heightmap type, for every column
+        counts = []
+        for state in self._palette:
+            block_name = state.split("[", 1)[0]
+            short_name = block_name.split(":", 1)[-1]
+            counted = block_name not in AIR
+            if name == "OCEAN_FLOOR":
+                counted = counted and short_name not in ("water", "lava")
+            if name.startswith("MOTION_BLOCKING"):
+                counted = counted and short_name not in NON_BLOCKING
+            if name == "MOTION_BLOCKING_NO_LEAVES":
+                counted = counted and not short_name.endswith("_leaves")
+            counts.append(counted)
+        mask = np.array(counts, dtype=bool)[self._blocks]
+
+        # Last counted block in every column, seen from the top
+        top = mask.shape[1] - np.argmax(mask[:, ::-1, :], axis=1)
+        top[~mask.any(axis=1)] = 0
+        offset = self._rect.offset - self._chunkRect.offset * 16
+        return (top[offset.x: offset.x + self._rect.size.x, offset.y: offset.y + self._rect.size.y]
+                + self._yBegin).astype(np.int_)
+
+    @property
+    def rect(self):
+        return self._rect
+
+    @property
+    def chunkRect(self):
+        return self._chunkRect
+
+    @property
+    def yBegin(self):
+        return self._yBegin
+
+    @property
+    def yEnd(self):
+        return self._yBegin + self._blocks.shape[1]
+
+    @property
+    def ySize(self):
+        return self._blocks.shape[1]
+
+    @property
+    def box(self):
+        return self._rect.toBox(offsetY=self._yBegin, sizeY=self.ySize)
+
+    @property
+    def heightmaps(self):
+        return self._heightmaps
+
+    def sections(self):
+        # Sections in the same form world_layers reads from real WorldSlices
+        biome_cells = self._biomes[::4, ::4]
+        for chunk_z in range(self._chunkRect.size.y):
+            for chunk_x in range(self._chunkRect.size.x):
+                columns = self._blocks[chunk_x * 16: chunk_x * 16 + 16, :, chunk_z * 16: chunk_z * 16 + 16]
+                biomes = biome_cells[chunk_x * 4: chunk_x * 4 + 4, chunk_z * 4: chunk_z * 4 + 4].T
+                for section_y in range(self.ySize // 16):
+                    indices = columns[:, section_y * 16: section_y * 16 + 16, :].transpose(1, 2, 0)
+                    yield LocalSection(self._chunkRect.offset.x + chunk_x, self._yBegin // 16 + section_y,
+                                       self._chunkRect.offset.y + chunk_z, self._palette, indices,
+                                       self._biome_palette, np.broadcast_to(biomes, (4, 4, 4)))
+
+    def block_entity_positions(self):
+        # Block entity data is kept inside the block state string, after the properties
+        has_data = np.array(["{" in state for state in self._palette], dtype=bool)
+        x, y, z = np.nonzero(has_data[self._blocks])
+        return [(int(x[i]) + self._chunkRect.offset.x * 16, int(y[i]) + self._yBegin,
+                 int(z[i]) + self._chunkRect.offset.y * 16) for i in range(len(x))]
+
+    def _index(self, position):
+        x = position[0] - self._chunkRect.offset.x * 16
+        y = position[1] - self._yBegin
+        z = position[2] - self._chunkRect.offset.y * 16
+        if 0 <= x < self._blocks.shape[0] and 0 <= y < self._blocks.shape[1] and 0 <= z < self._blocks.shape[2]:
+            return x, y, z
+        return None
+
+    def getBlockGlobal(self, position):
+        index = self._index(position)
+        if index is None:
+            return Block("minecraft:void_air")
+        return block_from_state(self._palette[self._blocks[index]])
+
+    def getBlock(self, position):
+        return self.getBlockGlobal(ivec3(*position) + ivec3(self._rect.offset.x, 0, self._rect.offset.y))
+
+    def getBiomeGlobal(self, position):
+        index = self._index(position)
+        if index is None:
+            return ""
+        return self._biome_palette[self._biomes[index[0], index[2]]]
+
+    def getBiome(self, position):
+        return self.getBiomeGlobal(ivec3(*position) + ivec3(self._rect.offset.x, 0, self._rect.offset.y))
+
+
+class LocalEditor:
+    """Stand-in for gdpc.Editor that reads and writes a LocalWorld instead of a server"""
+
+    def __init__(self, world, buffering=False, bufferLimit=1024, caching=False):
+        self.world = world
+        self.transform = Transform()
+        self.bufferLimit = bufferLimit
+        self.caching = caching
+        self.host = "local"
+        self.doBlockUpdates = True
+        self._buffering = buffering
+        self._buffer = {}
+        self._commandBuffer = []
+        self._cache = {}
+
+        # Simulated traffic, one request per call the real Editor would send to GDMC-HTTP
+        self.requests = 0
+        self.blocks_placed = 0
+        self.commands_run = 0
+
+    @property
+    def buffering(self):
+        return self._buffering
+
+    @buffering.setter
+    def buffering(self, value):
+        if self._buffering and not value:
+            self.flushBuffer()
+        self._buffering = value
+
+    def checkConnection(self):
+        pass
+
+    def getBuildArea(self):
+        self.requests += 1
+        return self.world.build_area
+
+    def setBuildArea(self, buildArea):
+        self.requests += 1
+        self.world.build_area = buildArea
+        return buildArea
+
+    def loadWorldSlice(self, rect=None, heightmapTypes=None, cache=False):
+        self.requests += 1
+        if rect is None:
+            rect = self.world.build_area.toRect()
+        return LocalWorldSlice(self.world, rect, heightmapTypes)
+
+    def getHeightmap(self, position=None, size=None, heightmapType="WORLD_SURFACE"):
+        # Same arguments as gdpc.interface.getHeightmap, (x, y, z) position and size, y is ignored
+        if position is None:
+            rect = self.world.build_area.toRect()
+        else:
+            rect = Rect(ivec2(position[0], position[2]), ivec2(size[0], size[2]))
+        heightmap = LocalWorldSlice(self.world, rect, (heightmapType,)).heightmaps[heightmapType]
+        self.requests += 1
+        return heightmap
+
+    def getBlock(self, position):
+        return self.getBlockGlobal(self.transform * position)
+
+    def getBlockGlobal(self, position):
+        position = ivec3(*position)
+        if self.caching and position in self._cache:
+            return self._cache[position]
+        self.requests += 1
+        index = self.world.local(position)
+        if index is None:
+            return Block("minecraft:void_air")
+        return block_from_state(self.world.palette[self.world.blocks[index]])
+
+    def getBiome(self, position):
+        return self.getBiomeGlobal(self.transform * position)
+
+    def getBiomeGlobal(self, position):
+        self.requests += 1
+        index = self.world.local(position)
+        if index is None:
+            return ""
+        return self.world.biome_palette[self.world.biomes[index[0], index[2]]]
+
+    def placeBlock(self, position, block, replace=None):
+        return self.placeBlockGlobal(position, block, replace)
+
+    def placeBlockGlobal(self, position, block, replace=None):
+        # Same single position check as gdpc
+        if hasattr(position, "__len__") and len(position) == 3 and isinstance(position[0], Integral):
+            positions = [position]
+        else:
+            positions = position
+
+        if isinstance(replace, str):
+            replace = [replace]
+        for pos in positions:
+            pos = ivec3(*pos)
+            placed = block if isinstance(block, Block) else random.choice(block)
+            if not placed.id:
+                continue
+            if replace is not None and self.getBlockGlobal(pos).id not in replace:
+                continue
+            if self._buffering:
+                if len(self._buffer) >= self.bufferLimit:
+                    self.flushBuffer()
+                self._buffer.pop(pos, None)
+                self._buffer[pos] = placed
+            else:
+                self.requests += 1
+                self._write(pos, placed)
+            if self.caching:
+                self._cache[pos] = placed
+        return True
+
+    def _write(self, position, block):
+        self.blocks_placed += 1
+        index = self.world.local(position)
+        if index is not None:
+            self.world.blocks[index] = self.world.state_id(str(block))
+
+    def flushBuffer(self):
+        if self._buffer:
+            self.requests += 1
+            for position, block in self._buffer.items():
+                self._write(position, block)
+            self._buffer = {}
+        if self._commandBuffer:
+            self.requests += 1
+            for command in self._commandBuffer:
+                self._run(command)
+            self._commandBuffer = []
+
+    def awaitBufferFlushes(self, timeout=None):
+        pass
+
+    def runCommand(self, command, position=None, syncWithBuffer=False):
+        self.runCommandGlobal(command, position, syncWithBuffer)
+
+    def runCommandGlobal(self, command, position=None, syncWithBuffer=False):
+        if self._buffering and syncWithBuffer:
+            self._commandBuffer.extend(command.split("\n"))
+            return
+        self.requests += 1
+        for line in command.split("\n"):
+            self._run(line)
+
+    def _run(self, command):
+        # Supports 'fill x1 y1 z1 x2 y2 z2 block [replace filter]' and 'setblock x y z block'
+        self.commands_run += 1
+        words = command.strip().lstrip("/").split(" ")
+        if words[0] == "setblock" and len(words) >= 5:
+            self._write(ivec3(*map(int, words[1:4])), block_from_state(words[4]))
+        elif words[0] == "fill" and len(words) >= 8:
+            first, last = tuple(map(int, words[1:4])), tuple(map(int, words[4:7]))
+            region = self.world.box_slices(first, last)
+            blocks = self.world.blocks[region]
+            state_id = self.world.state_id(words[7])
+            if len(words) >= 10 and words[8] == "replace":
+                # The filter matches every state of the given block
+                target = normalize_state(words[9]).split("[", 1)[0]
+                matches = np.array([state.split("[", 1)[0] == target for state in self.world.palette], dtype=bool)
+                selected = matches[blocks]
+            else:
+                selected = np.ones(blocks.shape, dtype=bool)
+            blocks[selected] = state_id
+            self.blocks_placed += int(selected.sum())
+
+    def getMinecraftVersion(self):
+        return "local"
+
+
+def smooth_noise(rng, shape, scale):
+    """
+    Value noise: a coarse random grid, bilinearly upsampled
+    :param rng: numpy random generator
+    :param shape: (x, z) shape of the result
+    :param scale: distance in blocks between grid points
+    :return numpy array: values between 0 and 1
+    """
+    grid = rng.random((shape[0] // scale + 2, shape[1] // scale + 2))
+    x = np.arange(shape[0]) / scale
+    z = np.arange(shape[1]) / scale
+    x0, z0 = x.astype(int), z.astype(int)
+    fx, fz = (x - x0)[:, None], (z - z0)[None, :]
+    return (grid[x0][:, z0] * (1 - fx) * (1 - fz) + grid[x0 + 1][:, z0] * fx * (1 - fz)
+            + grid[x0][:, z0 + 1] * (1 - fx) * fz + grid[x0 + 1][:, z0 + 1] * fx * fz)
+
+
+def terrain_heights(rng, shape, sea_level=62):
+    """
+    Rolling hills from a few octaves of value noise, roughly a third of the area ends up below sea level
+    :param rng: numpy random generator
+    :param shape: (x, z) shape of the result
+    :param sea_level: height the terrain is centered around
+    :return numpy array: height of the first air block above the ground of every column, int64
+    """
+    noise = (0.6 * smooth_noise(rng, shape, 64) + 0.3 * smooth_noise(rng, shape, 24)
+             + 0.1 * smooth_noise(rng, shape, 8))
+    return (sea_level - 6 + 28 * noise).astype(np.int64)
+
+
+def generate_world(size=256, seed=0, sea_level=62, y_begin=0, y_size=256, trees=True, offset=(0, 0)):
+    """
+    Generates synthetic terrain: rolling hills of stone, dirt and grass, lakes up to sea level, biome
+    regions and scattered trees. The build area covers size x size blocks from offset
+    :param size: side length of the build area, int or (x, z)
+    :param seed: random seed, equal seeds give equal worlds
+    :param sea_level: water fills every column up to this height
+    :param y_begin: lowest stored y level, multiple of 16
+    :param y_size: number of stored y levels, multiple of 16
+    :param trees: place trees in non desert biomes
+    :param offset: (x, z) of the build area corner
+    :return LocalWorld:
+    """
+    rng = np.random.default_rng(seed)
+    size = ivec2(size, size) if isinstance(size, Integral) else ivec2(*size)
+    area = Rect(ivec2(*offset), size)
+
+    # Chunk aligned storage around the build area
+    chunk_offset = area.offset >> 4
+    chunk_size = ((area.last >> 4) - chunk_offset) + 1
+    shape = (chunk_size.x * 16, chunk_size.y * 16)
+
+    heights = terrain_heights(rng, shape, sea_level)
+    heights = np.clip(heights, y_begin + 4, y_begin + y_size - 32)
+
+    # Biome regions from a second, smoother noise, constant over 4x4 cells like Minecraft stores them
+    biome_palette = list(SYNTHETIC_BIOMES)
+    temperature = smooth_noise(rng, (shape[0] // 4, shape[1] // 4), 24)
+    biomes = np.minimum((temperature * len(biome_palette)).astype(np.uint8), len(biome_palette) - 1)
+    biomes = biomes.repeat(4, axis=0).repeat(4, axis=1)
+
+    palette = ["minecraft:air", "minecraft:stone", "minecraft:dirt", "minecraft:grass_block", "minecraft:sand",
+               "minecraft:water[level=0]", "minecraft:snow_block", "minecraft:oak_log[axis=y]",
+               "minecraft:oak_leaves[distance=1,persistent=false,waterlogged=false]"]
+    air, stone, dirt, grass, sand, water, snow, log, leaves = range(len(palette))
+
+    y = np.arange(y_begin, y_begin + y_size)[None, :, None]
+    top = heights[:, None, :]
+    blocks = np.full((shape[0], y_size, shape[1]), air, dtype=np.uint16)
+    blocks[y < top - 3] = stone
+    blocks[(y >= top - 3) & (y < top)] = dirt
+
+    # Surface block depends on biome and on being under water
+    surface = np.full(shape, grass, dtype=np.uint16)
+    surface[biomes == biome_palette.index("minecraft:desert")] = sand
+    surface[biomes == biome_palette.index("minecraft:snowy_plains")] = snow
+    surface[heights <= sea_level] = sand
+    x_index, z_index = np.indices(shape)
+    blocks[x_index, heights - 1 - y_begin, z_index] = surface
+    blocks[(y >= top) & (y < sea_level)] = water
+
+    if trees:
+        desert = biome_palette.index("minecraft:desert")
+        count = shape[0] * shape[1] // 400
+        for x, z in zip(rng.integers(2, shape[0] - 2, count), rng.integers(2, shape[1] - 2, count)):
+            ground = heights[x, z]
+            if biomes[x, z] == desert or ground <= sea_level:
+                continue
+            trunk = int(rng.integers(4, 7))
+            base = ground - y_begin
+            blocks[x - 2: x + 3, base + trunk - 2: base + trunk + 1, z - 2: z + 3] = leaves
+            blocks[x, base: base + trunk, z] = log
+
+    # Build area corner in world coordinates, floor at y_begin
+    build_area = Box(ivec3(area.offset.x, y_begin, area.offset.y), ivec3(size.x, y_size, size.y))
+    return LocalWorld(chunk_offset * 16, blocks, palette, biomes, biome_palette, build_area, y_begin)
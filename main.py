@@ -1,4 +1,6 @@
+import argparse
 import sys
+from contextlib import nullcontext
 
 import numpy as np
 
@@ -6,72 +8,195 @@ from gdpc import __url__, Editor, Block
 from gdpc.exceptions import InterfaceConnectionError, BuildAreaNotSetError
 from gdpc.vector_tools import addY
 
-from settler import map_water, find_settlement_location, find_building_locations, place_outlines
+from settler import find_settlement_location, find_building_locations, place_outlines
 from foundationPlacement import createFoundations
-from schematics import build_structure
+from schematics import build_structure, warm_schematic_cache, schematic_cache_info
 from roads import buildRoads
 from remove_trees import remove
-
-# Create an editor object.
-# The Editor class provides a high-level interface to interact with the Minecraft world.
-editor = Editor()
-editor.buffering = True
-editor.caching = True
-
-# Check if the editor can connect to the GDMC HTTP interface.
-try:
-    editor.checkConnection()
-except InterfaceConnectionError:
-    print(
-        f"Error: Could not connect to the GDMC HTTP interface at {editor.host}!\n"
-        "To use GDPC, you need to use a \"backend\" that provides the GDMC HTTP interface.\n"
-        "For example, by running Minecraft with the GDMC HTTP mod installed.\n"
-        f"See {__url__}/README.md for more information."
-    )
-    sys.exit(1)
-
-# Get the build area.
-try:
-    buildArea = editor.getBuildArea()
-except BuildAreaNotSetError:
-    print(
-        "Error: failed to get the build area!\n"
-        "Make sure to set the build area with the /setbuildarea command in-game.\n"
-        "For example: /setbuildarea ~0 0 ~0 ~64 200 ~64"
-    )
-    sys.exit(1)
-
-print("Loading world slice...")
-buildRect = buildArea.toRect()
-worldSlice = editor.loadWorldSlice(buildRect)
-print("World slice loaded!")
-
-vec = addY(buildRect.center, 30)
-
-heightmap = worldSlice.heightmaps["MOTION_BLOCKING_NO_LEAVES"]
-
-print(f"Heightmap shape: {heightmap.shape}")
-
-print(f"Average height: {int(np.mean(heightmap))}")
-
-begin = buildArea.begin
-end = buildArea.end
-
-# remove(editor, buildArea)
-water_array = map_water(editor, begin, end, heightmap)
-settlement_plot, settlement_water, negative, positive = find_settlement_location(begin, water_array, heightmap)
-building_plots = find_building_locations(editor, settlement_plot, settlement_water, negative)
-
-num_buildings = 12
-
-createFoundations(editor, building_plots, num_buildings)
-
-structures = []
-
-for plot in building_plots[:num_buildings]:
-    structure = build_structure(editor, plot)
-    #TODO set custom door location for houses
-    structure.set_door((-1, -1, -6))
-    structures.append(structure)
-
-buildRoads(heightmap, begin, structures)
\ No newline at end of file
+from biome import BiomeMap
+from local_world import LocalEditor, generate_world
+from world_layers import slice_layers, stream_layers
+from terrain_cache import CACHE_DIRECTORY, TerrainCache, world_fingerprint
+from instrumentation import StageProfiler
+from placement_pipeline import PlacementPipeline
+from write_diff import WriteDiffer
+from build_plan import BuildPlan
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a settlement in the build area")
+    parser.add_argument("--local", type=int, metavar="SIZE",
+                        help="run on a generated SIZE x SIZE in-memory world instead of a Minecraft server")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the generated world")
+    parser.add_argument("--tile-chunks", type=int, metavar="N",
+                        help="load the build area in tiles of N x N chunks instead of one world slice")
+    parser.add_argument("--pyramid-levels", type=int, default=0, metavar="N",
+                        help="coarse-to-fine settlement search over N downsampled levels, for large build areas")
+    parser.add_argument("--top-k", type=int, default=8,
+                        help="plots the pyramid search refines per level, higher is slower but more accurate")
+    parser.add_argument("--settlement-workers", type=int, metavar="N",
+                        help="split the settlement search into tiles scored by a pool of N processes")
+    parser.add_argument("--multi-source-roads", action="store_true",
+                        help="connect all doors to the highway with one search instead of one search per door")
+    parser.add_argument("--road-workers", type=int, metavar="N",
+                        help="plan the road of every building separately in a pool of N processes")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="send placements from a background thread while the next stage is computed")
+    parser.add_argument("--plan", action="store_true",
+                        help="collect foundations, buildings and roads in one build plan and send it in a single flush")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="build the plan and print its block counts without placing anything")
+    parser.add_argument("--diff-writes", action="store_true",
+                        help="skip placements of blocks the world already holds or that were already placed")
+    parser.add_argument("--cache", nargs="?", const=CACHE_DIRECTORY, metavar="DIR",
+                        help="keep the terrain layers of the build area in DIR and reuse them while the world is unchanged")
+    parser.add_argument("--invalidate-cache", action="store_true",
+                        help="rebuild the cached terrain layers of the build area")
+    parser.add_argument("--profile", nargs="?", const="stage_trace.json", metavar="TRACE",
+                        help="record time, requests, blocks and peak memory per stage and write them as JSON to TRACE")
+    args = parser.parse_args()
+
+    # Create an editor object.
+    # The Editor class provides a high-level interface to interact with the Minecraft world.
+    if args.local:
+        editor = LocalEditor(generate_world(args.local, args.seed))
+    else:
+        editor = Editor()
+    editor.buffering = True
+    editor.caching = True
+
+    # Per-stage instrumentation, a no-op unless --profile is given
+    profiler = StageProfiler(editor, enabled=args.profile is not None)
+
+    # Check if the editor can connect to the GDMC HTTP interface.
+    try:
+        editor.checkConnection()
+    except InterfaceConnectionError:
+        print(
+            f"Error: Could not connect to the GDMC HTTP interface at {editor.host}!\n"
+            "To use GDPC, you need to use a \"backend\" that provides the GDMC HTTP interface.\n"
+            "For example, by running Minecraft with the GDMC HTTP mod installed.\n"
+            f"See {__url__}/README.md for more information."
+        )
+        sys.exit(1)
+
+    # Get the build area.
+    try:
+        buildArea = editor.getBuildArea()
+    except BuildAreaNotSetError:
+        print(
+            "Error: failed to get the build area!\n"
+            "Make sure to set the build area with the /setbuildarea command in-game.\n"
+            "For example: /setbuildarea ~0 0 ~0 ~64 200 ~64"
+        )
+        sys.exit(1)
+
+    print("Loading world slice...")
+    buildRect = buildArea.toRect()
+    with profiler.stage("load world slice"):
+        # Reruns on an unchanged build area read the layers from disk instead of the world
+        cache = TerrainCache(args.cache, editor.host) if args.cache else None
+        if cache is not None and args.invalidate_cache:
+            cache.invalidate(buildRect)
+        fingerprint = world_fingerprint(editor, buildRect) if cache is not None else None
+        layers = cache.load(buildRect, fingerprint) if cache is not None else None
+        worldSlice = None
+        if layers is not None:
+            print("Terrain layers loaded from cache")
+        else:
+            if args.tile_chunks:
+                # Only the layers used below are kept, one tile of raw chunk data is in memory at a time
+                layers = stream_layers(editor, buildRect, args.tile_chunks)
+            else:
+                worldSlice = editor.loadWorldSlice(buildRect)
+                layers = slice_layers(worldSlice)
+            if cache is not None:
+                cache.store(buildRect, fingerprint, layers)
+        heightmap = layers.heightmaps["MOTION_BLOCKING_NO_LEAVES"]
+    print("World slice loaded!")
+
+    vec = addY(buildRect.center, 30)
+
+    print(f"Heightmap shape: {heightmap.shape}")
+
+    print(f"Average height: {int(np.mean(heightmap))}")
+
+    begin = buildArea.begin
+    end = buildArea.end
+
+    # remove(editor, buildArea, masked=True)
+    water_array = layers.water
+    biome_map = BiomeMap(layers.biome_palette, layers.biome_ids, buildRect.offset.x, buildRect.offset.y)
+    with profiler.stage("settlement search"):
+        settlement_plot, settlement_water, negative, positive = find_settlement_location(begin, water_array, heightmap,
+                                                                                         args.pyramid_levels, args.top_k,
+                                                                                         args.settlement_workers)
+    with profiler.stage("building search"):
+        building_plots = find_building_locations(editor, settlement_plot, settlement_water, negative, biome_map)
+
+    num_buildings = 12
+
+    # From here on only blocks are placed, with --pipeline they are sent while the next stages run
+    placer = PlacementPipeline(editor) if args.pipeline else editor
+    # Placements of blocks the world already holds are dropped before they reach the pipeline or editor
+    if args.diff_writes:
+        placer = WriteDiffer(placer, worldSlice, layers)
+    # With --plan the stages write into one BuildPlan, which is sent to the placer in a single flush at the end
+    plan = BuildPlan() if args.plan or args.dry_run else None
+    writer = plan if plan is not None else placer
+
+    with profiler.stage("foundations"):
+        createFoundations(writer, building_plots, num_buildings)
+
+    with profiler.stage("load schematics"):
+        warm_schematic_cache(plot.schematic_path for plot in building_plots[:num_buildings])
+
+    structures = []
+
+    for number, plot in enumerate(building_plots[:num_buildings]):
+        # Buildings win over the roads planned after them wherever both write the same block
+        with profiler.stage(f"build structure {number}"), plan.priority(1) if plan is not None else nullcontext():
+            structure = build_structure(writer, plot, bulk=True)
+        #TODO set custom door location for houses
+        structure.set_door((-1, -1, -6))
+        structures.append(structure)
+
+    print("Schematic cache:", schematic_cache_info())
+
+    with profiler.stage("roads"):
+        buildRoads(writer, heightmap, begin, structures, multiSource=args.multi_source_roads,
+                   workers=args.road_workers)
+
+    # Blocks still in the buffer are sent here instead of when the editor is garbage collected,
+    # closing the pipeline waits until everything it was given has been sent
+    if plan is not None:
+        with profiler.stage("flush plan"):
+            summary = plan.flush(placer, dry_run=args.dry_run)
+        print("Build plan:", {name: value for name, value in summary.items() if name != "block_counts"})
+        if args.dry_run:
+            for block, count in summary["block_counts"].items():
+                print(f"{count:>8} {block}")
+
+    with profiler.stage("flush buffer"):
+        if args.diff_writes:
+            print("Write diff:", placer.statistics())
+            placer = placer.editor
+        if args.pipeline:
+            placer.close()
+            print("Placement pipeline:", placer.statistics())
+        editor.flushBuffer()
+
+    # Roads and buildings change blocks the fingerprint cannot see (grass to dirt_path), so the entry goes
+    if cache is not None and not args.dry_run:
+        cache.invalidate(buildRect)
+
+    if profiler.enabled:
+        print(profiler.summary())
+        profiler.write_trace(args.profile)
+        print(f"Stage trace written to {args.profile}")
+        profiler.close()
+
+
+# Worker processes of the road planner import this module, so the generator only runs when started directly
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+"""
+Pipelined block placement: generation keeps computing while earlier placements are being sent.
+
+PlacementPipeline wraps an editor and takes over its writes. Calls to placeBlock, placeBlockGlobal
+and runCommand are recorded into batches. Full batches go onto a bounded queue, and a single
+background thread sends them through the wrapped editor. The order of the calls is kept.
+
+Backpressure: when the queue is full, the generation thread waits for the sender, so pending
+placements never take more memory than queue_size batches.
+
+Barrier: reads (getBlock, loadWorldSlice, ...) and close() wait until everything placed before them
+has been sent, so the world that is read always contains all earlier writes.
+"""
+
+import queue
+import threading
+import time
+from numbers import Integral
+
+def is_single_position(position):
+    # Same check gdpc uses to tell one position from an iterable of positions
+    return hasattr(position, "__len__") and len(position) == 3 and isinstance(position[0], Integral)
+
+
+class PlacementPipeline:
+    """Editor wrapper that sends placements from a background thread through a bounded queue"""
+
+    def __init__(self, editor, queue_size=8, batch_size=None):
+        """
+        :param editor: editor that does the actual placing, only the sender thread uses it until close()
+        :param queue_size: number of batches that can wait to be sent before placing blocks waits
+        :param batch_size: blocks per batch, the editor's buffer limit by default so a batch is one request
+        """
+        self.editor = editor
+        self.batch_size = batch_size if batch_size is not None else getattr(editor, "bufferLimit", 1024)
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._batch = []
+        self._batch_blocks = 0
+        self._error = None
+        self._closed = False
+
+        # Statistics: batches and blocks sent, time spent waiting on a full queue and sending
+        self.batches_sent = 0
+        self.blocks_sent = 0
+        self.stall_seconds = 0.0
+        self.send_seconds = 0.0
+        self.max_queue_depth = 0
+
+        # Without buffering every deferred placeBlock would become its own request
+        editor.buffering = True
+        self._sender = threading.Thread(target=self._send_batches, name="placement-sender", daemon=True)
+        self._sender.start()
+
+    @property
+    def transform(self):
+        # gdpc geometry functions read the transform before placing
+        return self.editor.transform
+
+    @property
+    def buffering(self):
+        return True
+
+    def placeBlock(self, position, block, replace=None):
+        self._defer("placeBlock", position, block, replace)
+        return True
+
+    def placeBlockGlobal(self, position, block, replace=None):
+        self._defer("placeBlockGlobal", position, block, replace)
+        return True
+
+    def runCommand(self, command, position=None, syncWithBuffer=False):
+        # Commands run right after the placements before them, in their own batch
+        self._check_error()
+        self.flushBuffer()
+        self._put([("runCommand", (command, position), {})], 0)
+
+    def flushBuffer(self):
+        # Hands the current batch to the sender without waiting for it to be sent
+        if self._batch:
+            batch, blocks = self._batch, self._batch_blocks
+            self._batch, self._batch_blocks = [], 0
+            self._put(batch, blocks)
+
+    def awaitBufferFlushes(self, timeout=None):
+        self.barrier()
+
+    def barrier(self):
+        """
+        Waits until every placement made so far has been sent
+        :raises Exception: the first error raised by the sender thread
+        """
+        self.flushBuffer()
+        self._queue.join()
+        self._check_error()
+
+    def close(self):
+        # Final barrier, then stops the sender thread. The wrapped editor can be used directly again
+        if self._closed:
+            return
+        try:
+            self.barrier()
+        finally:
+            self._closed = True
+            self._queue.put(None)
+            self._sender.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __getattr__(self, name):
+        # Everything else (reads, loadWorldSlice, ...) goes to the editor once the writes before it are sent
+        if name.startswith("_") or name == "editor":
+            raise AttributeError(name)
+        self.barrier()
+        return getattr(self.editor, name)
+
+    def _defer(self, method, position, block, replace):
+        self._check_error()
+        if self._closed:
+            raise RuntimeError("Placement pipeline is closed")
+        # Iterables of positions may be generators, which must not be consumed by the sender later
+        blocks = 1
+        if not is_single_position(position):
+            position = list(position)
+            blocks = len(position)
+        self._batch.append((method, (position, block, replace), {}))
+        self._batch_blocks += blocks
+        if self._batch_blocks >= self.batch_size:
+            self.flushBuffer()
+
+    def _put(self, batch, blocks):
+        start = time.perf_counter()
+        self._queue.put((batch, blocks))
+        self.stall_seconds += time.perf_counter() - start
+        self.max_queue_depth = max(self.max_queue_depth, self._queue.qsize())
+
+    def _send_batches(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            batch, blocks = item
+            try:
+                # After an error the remaining batches are dropped, the error is raised on the main thread
+                if self._error is None:
+                    start = time.perf_counter()
+                    for method, args, kwargs in batch:
+                        getattr(self.editor, method)(*args, **kwargs)
+                    self.editor.flushBuffer()
+                    self.send_seconds += time.perf_counter() - start
+                    self.batches_sent += 1
+                    self.blocks_sent += blocks
+            except Exception as error:
+                self._error = error
+            finally:
+                self._queue.task_done()
+
+    def _check_error(self):
+        # An error stays set, every later call raises it again
+        if self._error is not None:
+            raise self._error
+
+    def statistics(self):
+        # Summary of the pipeline, for printing after close()
+        return {"batches": self.batches_sent, "blocks": self.blocks_sent, "max_queue_depth": self.max_queue_depth,
+                "stall_seconds": self.stall_seconds, "send_seconds": self.send_seconds}
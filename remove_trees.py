@@ -4,6 +4,8 @@ from gdpc.exceptions import InterfaceConnectionError, BuildAreaNotSetError
 from gdpc.vector_tools import *
 import numpy as np
 import itertools
+from world_layers import block_volume, chunk_tiles, stream_layers
+from schematics import MAX_FILL_VOLUME, fill_command, merge_regions, run_commands
 
 # Dictionary of all target blocks to remove
 blocks_to_remove = {
@@ -43,13 +45,19 @@ blocks_to_remove = {
 
 
 # Function to remove target blocks
-def remove(editor, buildArea):
+def remove(editor, buildArea, masked=False, tile_chunks=None):
 
     buildRectangle = buildArea.toRect()
 
-    worldslice = editor.loadWorldSlice(buildRectangle)
-
-    heightmap = worldslice.heightmaps["WORLD_SURFACE"]
+    #Large areas are loaded a tile of chunks at a time instead of in one world slice
+    if tile_chunks is not None and masked:
+        return remove_masked_tiled(editor, buildArea, tile_chunks)
+    if tile_chunks is not None:
+        layers = stream_layers(editor, buildRectangle, tile_chunks, ("WORLD_SURFACE",), surface=False)
+        heightmap = layers.heightmaps["WORLD_SURFACE"]
+    else:
+        worldslice = editor.loadWorldSlice(buildRectangle)
+        heightmap = worldslice.heightmaps["WORLD_SURFACE"]
 
     #Find highest y level in build area
     max_surface_height = np.max(heightmap)
@@ -57,6 +65,11 @@ def remove(editor, buildArea):
     min_surface_height = np.min(heightmap)
     #Step is the size of area to clear at once (16X16)
     step = 16
+
+    #Only send removals for blocks that are actually there
+    if masked:
+        return remove_masked(editor, buildArea, worldslice, min_surface_height, max_surface_height + 20, step)
+
     #Loop through X and Z ranges
     for x_start in range(0, len(heightmap) + 1, step):
         for z_start in range(0, len(heightmap[0]) + 1, step):
@@ -66,4 +79,76 @@ def remove(editor, buildArea):
                 editor.runCommand('fill ' + str(buildArea.begin.x + x_start) + ' ' + str(min_surface_height) + ' ' + str(buildArea.begin.z + z_start) + ' ' + str(buildArea.begin.x + x_start + step-1) + ' ' + str(max_surface_height + 20) + ' ' + str(buildArea.begin.z + z_start + step-1) + ' air replace ' + block)
 
 
+def remove_masked(editor, buildArea, worldslice, y_low, y_high, step=16):
+    """
+    Clears target blocks using a mask built from one scan of the world slice. Neighbouring step sized
+    cells holding the same target block type are merged into one fill command, limited to the box the
+    blocks of that type occupy
+    :param editor: editor instance
+    :param buildArea: build area to clear
+    :param worldslice: loaded WorldSlice of the build area
+    :param y_low: lowest y level to clear
+    :param y_high: highest y level to clear
+    :param step: side length of the cells that are merged into fills
+    :return dict: commands sent and commands the per-block-type fill loop would have sent
+    """
+    begin = buildArea.begin
+    size = buildArea.toRect().size
+
+    # Index of the target block of every position, -1 for blocks that stay
+    palette, ids = block_volume(worldslice, (begin.x, y_low, begin.z), (begin.x + size.x, y_high + 1, begin.z + size.y))
+    targets = sorted(blocks_to_remove)
+    target_ids = {block: i for i, block in enumerate(targets)}
+    lookup = np.array([target_ids.get(state.split("[", 1)[0], -1) for state in palette] + [-1], dtype=np.int32)
+    target_volume = lookup[ids]
+
+    # Positions are grouped in step x step x step cells. merge_regions joins neighbouring cells holding the
+    # same target block into boxes across column borders, and every box is shrunk to the blocks it holds
+    shape = [-(-length // step) * step for length in target_volume.shape]
+    padded = np.full(shape, -1, dtype=np.int32)
+    padded[:target_volume.shape[0], :target_volume.shape[1], :target_volume.shape[2]] = target_volume
+    cells = padded.reshape(shape[0] // step, step, shape[1] // step, step, shape[2] // step, step)
+
+    commands = []
+    for target in np.unique(target_volume[target_volume >= 0]):
+        present = (cells == target).any(axis=(1, 3, 5))
+        boxes = merge_regions(np.zeros(present.shape, dtype=np.int32), present, max(MAX_FILL_VOLUME // step ** 3, 1))
+        for i, j, k, i_end, j_end, k_end, _ in boxes:
+            box = padded[i * step: i_end * step, j * step: j_end * step, k * step: k_end * step]
+            xs, ys, zs = np.nonzero(box == target)
+            commands.append(fill_command(
+                (begin.x + i * step + xs.min(), y_low + j * step + ys.min(), begin.z + k * step + zs.min()),
+                (begin.x + i * step + xs.max(), y_low + j * step + ys.max(), begin.z + k * step + zs.max()),
+                "air", f"replace {targets[target]}"))
+
+    run_commands(editor, commands)
+
+    columns = len(range(0, size.x + 1, step)) * len(range(0, size.y + 1, step))
+    summary = {"commands": len(commands), "unmasked_commands": columns * len(blocks_to_remove)}
+    print(f"Cleared vegetation with {summary['commands']} fill commands, "
+          f"saved {summary['unmasked_commands'] - summary['commands']} commands")
+    return summary
+
+
+def remove_masked_tiled(editor, buildArea, tile_chunks=8, step=16):
+    """
+    remove_masked one chunk aligned tile at a time, only one tile's world slice is in memory at once.
+    Each tile is cleared from its own lowest surface up to 20 blocks above its highest surface
+    :param editor: editor instance
+    :param buildArea: build area to clear
+    :param tile_chunks: side length of a tile in chunks
+    :param step: side length of the cells that are merged into fills
+    :return dict: commands sent and commands the per-block-type fill loop would have sent
+    """
+    size = buildArea.toRect().size
+    commands = 0
+    for tile in chunk_tiles(buildArea.toRect(), tile_chunks):
+        worldslice = editor.loadWorldSlice(tile, heightmapTypes=("WORLD_SURFACE",))
+        heightmap = worldslice.heightmaps["WORLD_SURFACE"]
+        tile_area = tile.toBox(buildArea.begin.y, buildArea.size.y)
+        commands += remove_masked(editor, tile_area, worldslice, np.min(heightmap), np.max(heightmap) + 20, step)["commands"]
+        del worldslice
 
+    # The fill loop works on the whole area, so its command count does not add up over tiles
+    columns = len(range(0, size.x + 1, step)) * len(range(0, size.y + 1, step))
+    return {"commands": commands, "unmasked_commands": columns * len(blocks_to_remove)}
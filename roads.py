@@ -1,14 +1,14 @@
-import sys
-from queue import PriorityQueue
-from gdpc import __url__, Editor, Block
-from gdpc.exceptions import InterfaceConnectionError, BuildAreaNotSetError
+import heapq
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+from gdpc import Block
 from glm import ivec3
 
-from schematics import *
 import numpy as np
 
-def buildRoads(heightmap, areaLow, buildings):
-    obstacles = []
+from shared_arrays import SharedArrays, attach_shared
+
+def buildRoads(editor, heightmap, areaLow, buildings, multiSource=False, workers=None):
     doors = []
     goals = []
 
@@ -16,44 +16,66 @@ def buildRoads(heightmap, areaLow, buildings):
     for b in buildings:
         doors.append(b.door)
 
-    # Adding the buildings and 1 block padding to the obstacles list
-    for building in buildings:
-        start = ivec3(building.start.x, building.start.y - 1, building.start.z)
-        for x in range(start.x - 8, start.x + 1):
-            for z in range(start.z - 8, start.z + 1):
-                obstacles.append(ivec3(x, start.y, z))
-
-        # Removing the door and block in front of it from obstacles
-        obstacles.remove(building.door)
-        if building.direction == "north":
-            obstacles.remove(ivec3(building.door.x, building.door.y, building.door.z - 1))
-        elif building.direction == "south":
-            obstacles.remove(ivec3(building.door.x, building.door.y, building.door.z + 1))
-        elif building.direction == "west":
-            obstacles.remove(ivec3(building.door.x - 1, building.door.y, building.door.z))
-        else:
-            obstacles.remove(ivec3(building.door.x + 1, building.door.y, building.door.z))
+    obstacles = obstacleMask(heightmap, areaLow, buildings)
 
     # creating the endpoints of the highway and pathing between them
     pts = lsrl(heightmap, areaLow, doors, obstacles)
-    highway = astar(heightmap, areaLow, pts[0], pts[1], obstacles)
+    highway = astar(heightmap, areaLow, pts[0], pts[1], obstacles) or []
     for block in highway:
         # print("placing block at:", block.pos.x, block.pos.y, block.pos.z)
         goals.append(block.pos)
         editor.placeBlock((block.pos.x, block.pos.y, block.pos.z), Block("dirt_path"))
         # editor.placeBlock((block.pos.x, block.pos.y, block.pos.z), Block("grass_block"))
 
-    # For each building path to the nearest point on the highway to path to
-    for building in buildings:
-        # print("DOOOOOOOOOOR:", building.door)
-        path = astar(heightmap, areaLow, building.door, findNearest(building.door, goals), obstacles)
-        # print("path built")
+    # Either one search spreading out from the whole highway, or one astar per building
+    # to the nearest point on the highway, optionally spread over a pool of worker processes
+    if multiSource:
+        paths = connectDoors(heightmap, areaLow, goals, doors, obstacles)
+    else:
+        searches = [(building.door, findNearest(building.door, goals)) for building in buildings]
+        # Without a highway (its endpoints walled in) there is no goal, those doors stay unconnected
+        searches = [(first, goal) for first, goal in searches if goal is not None]
+        if workers is not None and workers > 1:
+            paths = planPaths(heightmap, areaLow, searches, obstacles, workers)
+        else:
+            paths = [astar(heightmap, areaLow, first, goal, obstacles) for first, goal in searches]
+
+    # Paths are placed here in building order, however they were planned
+    for path in paths:
+        # Doors that are walled in by steep terrain or other buildings stay unconnected
+        if path is None:
+            continue
         for block in path:
             # print("placing block at:", block.pos.x, block.pos.y, block.pos.z)
             editor.placeBlock((block.pos.x, block.pos.y, block.pos.z), Block("dirt_path"))
             #editor.placeBlock((block.pos.x, block.pos.y, block.pos.z), Block("grass_block"))
 
 
+# Boolean mask of the columns roads may not use, aligned with the heightmap
+def obstacleMask(heightmap, areaLow, buildings, padding=0):
+    obstacles = np.zeros(np.shape(heightmap), dtype=bool)
+    sizeX, sizeZ = obstacles.shape
+
+    # Adding the buildings and padding to the obstacles
+    for building in buildings:
+        x = building.start.x - areaLow[0]
+        z = building.start.z - areaLow[2]
+        obstacles[max(x - 8 - padding, 0): max(x + 1 + padding, 0),
+                  max(z - 8 - padding, 0): max(z + 1 + padding, 0)] = True
+
+    # Removing the door and block in front of it from obstacles
+    offsets = {"north": (0, -1), "south": (0, 1), "west": (-1, 0), "east": (1, 0)}
+    for building in buildings:
+        dx, dz = offsets.get(building.direction, offsets["east"])
+        x = building.door.x - areaLow[0]
+        z = building.door.z - areaLow[2]
+        for cellX, cellZ in ((x, z), (x + dx, z + dz)):
+            if 0 <= cellX < sizeX and 0 <= cellZ < sizeZ:
+                obstacles[cellX, cellZ] = False
+
+    return obstacles
+
+
 # Finds the nearest element of goals to pos
 def findNearest(pos, goals):
     best = None
@@ -84,14 +106,15 @@ def lsrl(heightmap, areaLow, points, obstacles):
     zhigh = int(np.mean(zValues) - slope * np.mean(xValues) + slope * xhigh)
     yhigh = heightmap[xhigh - areaLow[0]][zhigh - areaLow[2]] - 1
 
-    while ivec3(xlow, ylow, zlow) in obstacles or ivec3(xhigh, yhigh, zhigh) in obstacles:
-        if ivec3(xlow, ylow, zlow) in obstacles:
+    while obstacles[xlow - areaLow[0], zlow - areaLow[2]] or obstacles[xhigh - areaLow[0], zhigh - areaLow[2]]:
+        if obstacles[xlow - areaLow[0], zlow - areaLow[2]]:
             xlow += 1
             zlow = int(np.mean(zValues) - slope * np.mean(xValues) + slope * xlow)
             ylow = heightmap[xlow - areaLow[0]][zlow - areaLow[2]] - 1
 
-        if ivec3(xhigh, yhigh, zhigh) in obstacles:
-            xhigh += 1
+        # The high end walks back towards the low end so it stays inside the area
+        if obstacles[xhigh - areaLow[0], zhigh - areaLow[2]]:
+            xhigh -= 1
             zhigh = int(np.mean(zValues) - slope * np.mean(xValues) + slope * xhigh)
             yhigh = heightmap[xhigh - areaLow[0]][zhigh - areaLow[2]] - 1
 
@@ -99,46 +122,198 @@ def lsrl(heightmap, areaLow, points, obstacles):
     return [ivec3(xlow, ylow, zlow), ivec3(xhigh, yhigh, zhigh)]
 
 
-# Astar search pathing algorithm
+# Astar search pathing algorithm over the heightmap grid
 def astar(heightmap, areaLow, first, goal, obstacles):
-    queue = PriorityQueue()
-    start = Node(first, None, goal)
-    closed = []
-    open = [start.pos]
-    queue.put(start)
+    sizeX, sizeZ = heightmap.shape
+
+    # Height of the path block in every column, the start keeps its own height
+    heights = np.asarray(heightmap, dtype=np.int64) - 1
+    start = (first.x - areaLow[0], first.z - areaLow[2])
+    end = (goal.x - areaLow[0], goal.z - areaLow[2])
+    heights[start] = first.y
 
-    while not queue.empty():
-        current = queue.get()
-        open.remove(current.pos)
-        #print("heuristic:", current.h, current.pos)
+    # Search state indexed by (x, z)
+    gScore = np.full(heights.shape, np.iinfo(np.int64).max, dtype=np.int64)
+    parent = np.full(heights.shape, -1, dtype=np.int64)
+    closed = np.zeros(heights.shape, dtype=bool)
+    gScore[start] = 0
+
+    # The counter breaks ties between equal f scores in insertion order
+    counter = itertools.count()
+    queue = [(abs(end[0] - start[0]) + abs(end[1] - start[1]), next(counter), start)]
+
+    while queue:
+        _, _, current = heapq.heappop(queue)
+        if closed[current]:
+            continue
 
         # If the goal is reached, backtrack the path and return
-        if current.h == 0:
-            path = []
-            current = current.parent
-            while current.parent is not None:
-                path.append(current)
-                current = current.parent
-            path.reverse()
-
-            return path
-
-        closed.append(current.pos)
-
-        # Adding new nodes to the queue
-        for neighbor in current.possibleBlocks(heightmap, areaLow):
-            #print("neighbor")
-            if neighbor not in obstacles and neighbor not in closed:
-                if neighbor in open:  # implement this later for better functionality
-                    pass
-                else:
-                    #print("adding")
-                    queue.put(Node(neighbor, current, goal))
-                    open.append(neighbor)
-    
+        if current == end:
+            return backtrack(heights, areaLow, parent, start, end, goal)
+
+        closed[current] = True
+        x, z = current
+        g = gScore[current]
+        y = heights[current]
+
+        # Adding new nodes to the queue, elevation changes count double to avoid hills
+        for neighbor in ((x + 1, z), (x, z + 1), (x - 1, z), (x, z - 1)):
+            if not (0 <= neighbor[0] < sizeX and 0 <= neighbor[1] < sizeZ):
+                continue
+            if closed[neighbor] or obstacles[neighbor]:
+                continue
+
+            cost = g + 1 + 2 * abs(heights[neighbor] - y)
+            if cost < gScore[neighbor]:
+                gScore[neighbor] = cost
+                parent[neighbor] = x * sizeZ + z
+                h = abs(end[0] - neighbor[0]) + abs(end[1] - neighbor[1])
+                heapq.heappush(queue, (cost + h, next(counter), neighbor))
+
     return None
 
 
+# Runs one astar per (first, goal) pair in a process pool. The heightmap and obstacles are put in shared
+# memory once, so workers attach to them instead of receiving a pickled copy with every search
+# Returns the paths in the order of the searches, None where there is no path
+def planPaths(heightmap, areaLow, searches, obstacles, workers):
+    arrays = {"heightmap": np.asarray(heightmap, dtype=np.int64), "obstacles": np.asarray(obstacles, dtype=bool)}
+    tasks = [(tuple(areaLow), tuple(first), tuple(goal)) for first, goal in searches]
+    with SharedArrays(arrays) as shared:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_attachShared,
+                                 initargs=(shared.layouts,)) as pool:
+            # map returns results in task order, whichever worker finishes first
+            results = list(pool.map(_searchShared, tasks))
+
+    # Rebuilding the nodes on the main thread, the parent chains are not sent between processes
+    paths = []
+    for (first, goal), positions in zip(searches, results):
+        if positions is None:
+            paths.append(None)
+            continue
+        path = []
+        node = Node(first, None, goal)
+        for position in positions:
+            node = Node(ivec3(*position), node, goal)
+            path.append(node)
+        paths.append(path)
+    return paths
+
+
+# Shared arrays of the worker process, set once by _attachShared
+_shared = {}
+
+
+def _attachShared(layouts):
+    _shared.update(attach_shared(layouts))
+
+
+def _searchShared(task):
+    areaLow, first, goal = task
+    path = astar(_shared["heightmap"], areaLow, ivec3(*first), ivec3(*goal), _shared["obstacles"])
+    if path is None:
+        return None
+    return [(node.pos.x, node.pos.y, node.pos.z) for node in path]
+
+
+# Connects every door to the cheapest reachable source block with a single multi-source Dijkstra
+# search, so the cost does not grow with the number of doors
+def connectDoors(heightmap, areaLow, sources, doors, obstacles):
+    heights = np.asarray(heightmap, dtype=np.int64) - 1
+    sourceCells = [(source.x - areaLow[0], source.z - areaLow[2]) for source in sources]
+    doorCells = [(door.x - areaLow[0], door.z - areaLow[2]) for door in doors]
+    for door, cell in zip(doors, doorCells):
+        heights[cell] = door.y
+
+    parent = distanceField(heights, obstacles, sourceCells, doorCells)
+
+    # Reading a path back from the field is following the parents from the door to the highway
+    paths = []
+    for door, cell in zip(doors, doorCells):
+        if parent[cell] == -1 and cell not in sourceCells:
+            paths.append(None)
+            continue
+        paths.append(readPath(heights, areaLow, parent, cell, door))
+
+    return paths
+
+
+# Grows the cost field from all sources at once until every target is settled
+# Returns the parent (flattened index, -1 for none) of every column
+def distanceField(heights, obstacles, sources, targets):
+    sizeX, sizeZ = heights.shape
+    distance = np.full(heights.shape, np.iinfo(np.int64).max, dtype=np.int64)
+    parent = np.full(heights.shape, -1, dtype=np.int64)
+    closed = np.zeros(heights.shape, dtype=bool)
+    remaining = set(targets)
+
+    counter = itertools.count()
+    queue = []
+    for source in sources:
+        distance[source] = 0
+        queue.append((0, next(counter), source))
+    heapq.heapify(queue)
+
+    while queue and remaining:
+        _, _, current = heapq.heappop(queue)
+        if closed[current]:
+            continue
+        closed[current] = True
+        remaining.discard(current)
+
+        x, z = current
+        d = distance[current]
+        y = heights[current]
+        for neighbor in ((x + 1, z), (x, z + 1), (x - 1, z), (x, z - 1)):
+            if not (0 <= neighbor[0] < sizeX and 0 <= neighbor[1] < sizeZ):
+                continue
+            if closed[neighbor] or obstacles[neighbor]:
+                continue
+
+            cost = d + 1 + 2 * abs(heights[neighbor] - y)
+            if cost < distance[neighbor]:
+                distance[neighbor] = cost
+                parent[neighbor] = x * sizeZ + z
+                heapq.heappush(queue, (cost, next(counter), neighbor))
+
+    return parent
+
+
+# Follows the parents from a door towards the source it was reached from
+# Returns the nodes between the door and the source, door side first
+def readPath(heights, areaLow, parent, start, door):
+    sizeZ = heights.shape[1]
+    path = []
+    node = Node(door, None, door)
+    current = parent[start]
+    while current != -1 and parent[current // sizeZ, current % sizeZ] != -1:
+        x, z = current // sizeZ, current % sizeZ
+        node = Node(ivec3(int(x + areaLow[0]), int(heights[x, z]), int(z + areaLow[2])), node, door)
+        path.append(node)
+        current = parent[x, z]
+
+    return path
+
+
+# Follows parents back from the end and returns the nodes between start and end, start first
+def backtrack(heights, areaLow, parent, start, end, goal):
+    sizeZ = heights.shape[1]
+    cells = []
+    current = parent[end]
+    while current != -1 and (current // sizeZ, current % sizeZ) != start:
+        cells.append((current // sizeZ, current % sizeZ))
+        current = parent[cells[-1]]
+    cells.reverse()
+
+    path = []
+    node = Node(ivec3(int(start[0] + areaLow[0]), int(heights[start]), int(start[1] + areaLow[2])), None, goal)
+    for x, z in cells:
+        node = Node(ivec3(int(x + areaLow[0]), int(heights[x, z]), int(z + areaLow[2])), node, goal)
+        path.append(node)
+
+    return path
+
+
 class Node:
     def __init__(self, pos, parent, goal):
         # ALl the parameters needed, including e which represents elevation
@@ -161,29 +336,3 @@ class Node:
 
     def __eq__(self, other):
         return self.pos == other.pos
-
-    # Children nodes
-    def possibleBlocks(self, heightmap, areaLow):
-        blocks = []
-
-        # works for square heightmaps
-        length = len(heightmap)
-
-        if not self.pos.x + 1 - areaLow[0] >= length:
-            blocks.append(
-                ivec3(self.pos.x + 1, heightmap[self.pos.x + 1 - areaLow[0]][self.pos.z - areaLow[2]] - 1, self.pos.z))
-
-        if not self.pos.z + 1 - areaLow[2] >= length:
-            blocks.append(
-                ivec3(self.pos.x, heightmap[self.pos.x - areaLow[0]][self.pos.z + 1 - areaLow[2]] - 1, self.pos.z + 1))
-
-        if not self.pos.x - 1 - areaLow[0] < 0:
-            blocks.append(
-                ivec3(self.pos.x - 1, heightmap[self.pos.x - 1 - areaLow[0]][self.pos.z - areaLow[2]] - 1, self.pos.z))
-
-        if not self.pos.z - 1 - areaLow[2] < 0:
-            blocks.append(
-                ivec3(self.pos.x, heightmap[self.pos.x - areaLow[0]][self.pos.z - 1 - areaLow[2]] - 1, self.pos.z - 1))
-
-        return blocks
-
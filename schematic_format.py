@@ -0,0 +1,142 @@
+"""
+Compact binary schematic format: a block state palette plus a uint16 index volume.
+
+Layout of a .bsch file:
+    8 bytes   magic, b"GDMCSCH1"
+    4 bytes   little endian length of the JSON header
+    header    JSON with "shape", "dtype" and "palette", padded with spaces so the volume starts on a
+              16 byte boundary
+    volume    the raw index volume in C order, indexed [x, y, z] like the text schematics
+
+The volume is stored uncompressed so it can be memory-mapped instead of read into memory.
+Run this file to convert every text schematic in the Schematics directory.
+"""
+
+import ast
+import json
+import os
+import struct
+import sys
+
+import numpy as np
+
+BINARY_EXTENSION = ".bsch"
+TEXT_EXTENSION = ".txt"
+MAGIC = b"GDMCSCH1"
+ALIGNMENT = 16
+
+
+def binary_path(filename):
+    # Path of the binary schematic that belongs to a text schematic
+    return os.path.splitext(filename)[0] + BINARY_EXTENSION
+
+
+def remove_binary_schematic(filename):
+    # Deletes the binary schematic of a text schematic that was rewritten, so it is not loaded instead
+    binary_filename = binary_path(filename)
+    if os.path.exists(binary_filename):
+        os.remove(binary_filename)
+
+
+def read_text_schematic(filename):
+    """
+    Reads a nested-list text schematic into a palette and index volume
+    :param filename: path of the .txt schematic
+    :return tuple: (palette, indices) where palette is a list of block state strings
+    """
+    with open(filename, 'r') as file:
+        schematic_list = ast.literal_eval(file.read())
+
+    palette, indices = np.unique(np.array(schematic_list, dtype=str), return_inverse=True)
+    indices = indices.reshape(len(schematic_list), len(schematic_list[0]), len(schematic_list[0][0]))
+    return palette.tolist(), indices.astype(np.uint16)
+
+
+def write_binary_schematic(filename, palette, indices):
+    """
+    Writes a palette and index volume to a binary schematic file
+    :param filename: path of the .bsch file to write
+    :param palette: list of block state strings
+    :param indices: 3D array of palette indices, indexed [x, y, z]
+    """
+    if len(palette) > np.iinfo(np.uint16).max + 1:
+        raise ValueError(f"Schematic palette has {len(palette)} entries, at most 65536 fit in uint16")
+
+    volume = np.ascontiguousarray(indices, dtype="<u2")
+    header = json.dumps({"shape": list(volume.shape), "dtype": volume.dtype.str, "palette": list(palette)})
+    header = header.encode("utf-8")
+    padding = -(len(MAGIC) + 4 + len(header)) % ALIGNMENT
+    header += b" " * padding
+
+    with open(filename, 'wb') as file:
+        file.write(MAGIC)
+        file.write(struct.pack("<I", len(header)))
+        file.write(header)
+        file.write(volume.tobytes())
+
+
+def read_binary_schematic(filename, mmap=True):
+    """
+    Reads a binary schematic file
+    :param filename: path of the .bsch file
+    :param mmap: memory-map the index volume instead of reading it into memory
+    :return tuple: (palette, indices), indices is read-only when memory-mapped
+    """
+    with open(filename, 'rb') as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{filename} is not a binary schematic")
+        header_length, = struct.unpack("<I", file.read(4))
+        header = json.loads(file.read(header_length))
+
+    offset = len(MAGIC) + 4 + header_length
+    shape = tuple(header["shape"])
+    if mmap:
+        indices = np.memmap(filename, dtype=header["dtype"], mode='r', offset=offset, shape=shape)
+    else:
+        indices = np.fromfile(filename, dtype=header["dtype"], offset=offset).reshape(shape)
+
+    return header["palette"], indices
+
+
+def load_schematic(filename, mmap=True):
+    """
+    Loads a schematic as palette and index volume. The binary version of the file is used when it
+    exists and is not older than the text schematic, the text schematic is parsed otherwise
+    :param filename: path of the schematic, either the .txt or the .bsch file
+    :param mmap: memory-map binary schematics
+    :return tuple: (palette, indices)
+    """
+    binary_filename = binary_path(filename)
+    text_filename = os.path.splitext(filename)[0] + TEXT_EXTENSION
+    # A text schematic captured or edited after the conversion makes the binary one outdated
+    if os.path.exists(binary_filename) and (not os.path.exists(text_filename) or
+                                            os.path.getmtime(binary_filename) >= os.path.getmtime(text_filename)):
+        return read_binary_schematic(binary_filename, mmap)
+    return read_text_schematic(text_filename)
+
+
+def convert_schematics(directory="Schematics"):
+    """
+    Writes a binary schematic next to every text schematic in a directory
+    :param directory: directory to convert
+    :return list: paths of the written binary schematics
+    """
+    written = []
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith(".txt"):
+            continue
+        filename = os.path.join(directory, name)
+        palette, indices = read_text_schematic(filename)
+        write_binary_schematic(binary_path(filename), palette, indices)
+        written.append(binary_path(filename))
+        print(f"Converted {filename}: {indices.shape}, {len(palette)} block states")
+    return written
+
+
+def main():
+    directory = sys.argv[1] if len(sys.argv) > 1 else "Schematics"
+    convert_schematics(directory)
+
+
+if __name__ == "__main__":
+    main()
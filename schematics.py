@@ -3,64 +3,16 @@ import time
 
 import numpy as np
 from gdpc.utils import nonZeroSign
-from glm import ivec2, ivec3
+from glm import ivec3
 import os.path
-from gdpc import __url__, Editor, Block
-from gdpc.exceptions import InterfaceConnectionError, BuildAreaNotSetError
-from gdpc.vector_tools import addY, dropY
+from gdpc import Editor, Block, Rect
+from gdpc.vector_tools import dropY
 import os
 import ast
+from functools import lru_cache
 from settler import BuildingPlot
-
-
-# The minimum build area size in the XZ-plane
-MIN_BUILD_AREA_SIZE = ivec2(35, 35)
-
-# Create an editor object.
-editor = Editor()
-
-# Check if the editor can connect to the GDMC HTTP interface.
-try:
-    editor.checkConnection()
-except InterfaceConnectionError:
-    print(
-        f"Error: Could not connect to the GDMC HTTP interface at {editor.host}!\n"
-        "To use GDPC, you need to use a \"backend\" that provides the GDMC HTTP interface.\n"
-        "For example, by running Minecraft with the GDMC HTTP mod installed.\n"
-        f"See {__url__}/README.md for more information."
-    )
-    sys.exit(1)
-
-# Get the build area.
-try:
-    buildArea = editor.getBuildArea()
-except BuildAreaNotSetError:
-    print(
-        "Error: failed to get the build area!\n"
-        "Make sure to set the build area with the /setbuildarea command in-game.\n"
-        "For example: /setbuildarea ~0 0 ~0 ~64 200 ~64"
-    )
-    sys.exit(1)
-
-# Check if the build area is large enough in the XZ-plane.
-if any(dropY(buildArea.size) < MIN_BUILD_AREA_SIZE):
-    print(
-        "Error: the build area is too small for this example!\n"
-        f"It should be at least {tuple(MIN_BUILD_AREA_SIZE)} blocks large in the XZ-plane."
-    )
-    sys.exit(1)
-
-# Get a world slice
-print("Loading world slice...")
-buildRect = buildArea.toRect()
-worldSlice = editor.loadWorldSlice(buildRect)
-print("World slice loaded!")
-
-editor.buffering = False  # set to false to visualize load
-
-heightmap = worldSlice.heightmaps["MOTION_BLOCKING_NO_LEAVES"]
-meanHeight = np.mean(heightmap)
-groundCenter = addY(buildRect.center, meanHeight)
+from schematic_format import load_schematic, write_binary_schematic, binary_path, remove_binary_schematic
+from world_layers import block_volume, block_entity_positions
 
 
 class Structure:
@@ -78,14 +30,20 @@ class Structure:
         self.door = ivec3(self.start.x + offset[0], self.start.y + offset[1], self.start.z + offset[2])
 
 
-def write_schematic_to_file(filename, corner1, corner2):
+def write_schematic_to_file(filename, corner1, corner2, from_world_slice=False, binary=False, editor=None):
     """
     iterates through 3D space given by corners and writes them into schematic txt file
     corners are automatically converted into Southeast bottom, and its opposite corner
         :param filename: name of file to store array
         :param corner1: any given corner of the build, converted to SE, bottom
         :param corner2: opposite of corner 1, converted to NW, top
+        :param from_world_slice: capture all blocks from one WorldSlice instead of one getBlock per block
+        :param binary: also write the schematic in the binary format (requires from_world_slice)
+        :param editor: editor instance, a new Editor connected to GDMC-HTTP when None
     """
+    if editor is None:
+        editor = Editor()
+
     # Ensure the Schematics directory exists
     start_time = time.time()
 
@@ -100,6 +58,29 @@ def write_schematic_to_file(filename, corner1, corner2):
     corner1_c = [max(corner1[0], corner2[0]), min(corner1[1], corner2[1]), max(corner1[2], corner2[2])]
     corner2_c = [min(corner1[0], corner2[0]), max(corner1[1], corner2[1]), min(corner1[2], corner2[2])]
 
+    if from_world_slice:
+        schematic = capture_schematic(editor, corner1_c, corner2_c)
+
+        # Written one layer at a time through a large file buffer
+        with open(filepath, 'w', buffering=1 << 16) as file:
+            file.write("[\n")
+            for layer in schematic:
+                rows = "".join("        [" + "".join(f"'{block_name}', " for block_name in row) + "],\n"
+                               for row in layer)
+                file.write("    [\n" + rows + "    ],\n")
+            file.write("]\n")
+
+        if binary:
+            palette, indices = np.unique(schematic.astype(str), return_inverse=True)
+            write_binary_schematic(binary_path(filepath), palette.tolist(), indices.reshape(schematic.shape))
+        else:
+            remove_binary_schematic(filepath)
+
+        end_time = time.time()
+        print(f"Schematic written to {filepath}")
+        print("Created Schematic in:", end_time - start_time, "seconds")
+        return
+
     with open(filepath, 'w') as file:
         file.write("[\n")
         for x in range(corner1_c[0], corner2_c[0] + nonZeroSign(corner2_c[0] - corner1_c[0]),
@@ -119,12 +100,40 @@ def write_schematic_to_file(filename, corner1, corner2):
                 file.write("],\n")
             file.write("    ],\n")
         file.write("]\n")
+    remove_binary_schematic(filepath)
     end_time = time.time()
     print(f"Schematic written to {filepath}")
     elapsed_time = end_time - start_time
     print("Created Schematic in:", elapsed_time, "seconds")
 
 
+def capture_schematic(editor, corner1_c, corner2_c):
+    """
+    Loads one WorldSlice around the corrected corners and reads all block states from it in bulk
+    :param editor: editor instance
+    :param corner1_c: Southeast bottom corner (max x, min y, max z)
+    :param corner2_c: Northwest top corner (min x, max y, min z)
+    :return numpy array: block names without the minecraft: prefix, in the order the text schematics use
+    """
+    begin = ivec3(corner2_c[0], corner1_c[1], corner2_c[2])
+    end = ivec3(corner1_c[0], corner2_c[1], corner1_c[2]) + 1
+    world_slice = editor.loadWorldSlice(Rect(dropY(begin), dropY(end - begin)))
+
+    palette, ids = block_volume(world_slice, begin, end)
+    # Extra trailing entry for positions outside the loaded sections
+    names = np.array([state.split(":", 1)[1] for state in palette] + ["void_air"], dtype=object)
+    schematic = names[ids]
+
+    # Block entities (chests, signs, ...) carry data that the palette does not have
+    for position in block_entity_positions(world_slice):
+        local = ivec3(*position) - begin
+        if all(0 <= local[i] < schematic.shape[i] for i in range(3)):
+            schematic[tuple(local)] = str(world_slice.getBlockGlobal(position)).split(":", 1)[1]
+
+    # Same order as the text schematics: pos to neg X, bottom to top, pos to neg Z
+    return schematic[::-1, :, ::-1]
+
+
 def read_schematic_from_file(filename):
     """
     Reads schematic from file and returns it as a 3D numpy array representation of the blocks
@@ -143,7 +152,229 @@ def read_schematic_from_file(filename):
     return schematic_array
 
 
-def build_structure(editor, plot: BuildingPlot, direction="east"):
+# Maps the facing of blocks in an east facing schematic to the facing after rotating it
+FACING_MAPPINGS = {
+    "east": {},
+    "south": {"north": "east", "west": "north", "south": "west", "east": "south"},
+    "west": {"north": "north", "west": "east", "south": "south", "east": "west"},
+    "north": {"north": "west", "west": "south", "south": "east", "east": "north"},
+}
+
+# Number of (schematic, direction) pairs kept in memory
+SCHEMATIC_CACHE_SIZE = 32
+
+
+class RotatedSchematic:
+    """A schematic prepared for building in one direction, every unique block state is parsed once"""
+
+    def __init__(self, palette, indices, direction):
+        self.direction = direction
+        self.facing_mapping = FACING_MAPPINGS[direction]
+        self.indices = indices
+
+        # Per palette entry: rotated state, ready-made Block, and whether it is air or a door
+        self.palette = tuple(rotate_block_state(state, self.facing_mapping) for state in palette)
+        self.blocks = [Block(state) for state in self.palette]
+        self.air = np.array([state == "air" for state in self.palette], dtype=bool)
+        self.doors = np.array(["_door" in state.split('[', 1)[0] for state in self.palette], dtype=bool)
+
+        # Positions are (layer, row, block) offsets in build order, argwhere returns them in that order
+        air = self.air[indices]
+        doors = np.argwhere(self.doors[indices])
+        air_positions = np.argwhere(air)
+        self.door_offset = tuple(doors[0].tolist()) if len(doors) else None
+        self.last_air_offset = tuple(air_positions[-1].tolist()) if len(air_positions) else None
+        self.solid_offsets = np.argwhere(~air).tolist()
+
+
+def rotate_block_state(state, facing_mapping):
+    """
+    Remaps the facing property of a block state string
+    :param state: block state, e.g. 'oak_stairs[facing=north,half=bottom]'
+    :param facing_mapping: dict from old to new facing, empty for no rotation
+    :return String: the rotated block state
+    """
+    block_name, bracket, rest = state.partition('[')
+    if not facing_mapping or not bracket or 'facing=' not in rest:
+        return state
+
+    # Keep anything after the properties (block entity data) untouched
+    block_properties, bracket_close, data = rest.partition(']')
+    properties_list = block_properties.split(',')
+    for i, prop in enumerate(properties_list):
+        if 'facing=' in prop:
+            facing_direction = prop.split('facing=')[1].strip()
+            properties_list[i] = 'facing=' + facing_mapping.get(facing_direction, facing_direction)
+            break  # Exit loop after updating facing property
+
+    return block_name + '[' + ','.join(properties_list) + bracket_close + data
+
+
+@lru_cache(maxsize=SCHEMATIC_CACHE_SIZE)
+def load_rotated_schematic(schematic_path, direction="east"):
+    """
+    Loads a schematic rotated to face direction. Results are kept in an LRU cache keyed by
+    (schematic_path, direction), so the returned schematic is shared and must not be modified
+    :param schematic_path: path of the schematic
+    :param direction: String, direction building faces. East is default
+    :return RotatedSchematic: with read-only rotated indices
+    """
+    palette, indices = load_schematic(schematic_path)
+
+    # update rotation of structs
+    if direction == "south":
+        indices = np.rot90(indices, axes=(0, 2))
+    if direction == "west":
+        indices = np.flip(indices, 0)
+    if direction == "north":
+        indices = np.rot90(indices, k=-1, axes=(0, 2))
+
+    indices = np.array(indices)
+    indices.flags.writeable = False
+    return RotatedSchematic(palette, indices, direction)
+
+
+def warm_schematic_cache(schematic_paths, directions=("east",)):
+    """
+    Loads schematics into the cache ahead of building
+    :param schematic_paths: iterable of schematic paths, None entries are skipped
+    :param directions: directions to prepare each schematic for
+    """
+    for schematic_path in set(schematic_paths):
+        if schematic_path is None:
+            continue
+        for direction in directions:
+            load_rotated_schematic(schematic_path, direction)
+
+
+def schematic_cache_info():
+    # Hits, misses and size of the schematic cache
+    return load_rotated_schematic.cache_info()
+
+
+# Smallest box of identical blocks that is sent as one fill command instead of single blocks
+MIN_FILL_VOLUME = 4
+# Largest number of blocks a single fill command may change
+MAX_FILL_VOLUME = 32768
+# Number of commands sent per request
+COMMAND_BATCH_SIZE = 512
+
+
+def merge_regions(indices, solid, max_volume=MAX_FILL_VOLUME):
+    """
+    Greedily merges contiguous identical blocks into boxes. Boxes grow along Z, then Y, then X
+    :param indices: 3D array of palette indices
+    :param solid: 3D boolean mask of the blocks that need placing
+    :param max_volume: largest box volume allowed
+    :return list: boxes as (i, j, k, i_end, j_end, k_end, index), ends exclusive
+    """
+    covered = ~solid
+    size_i, size_j, size_k = indices.shape
+    regions = []
+
+    for i, j, k in np.argwhere(solid).tolist():
+        if covered[i, j, k]:
+            continue
+        value = indices[i, j, k]
+
+        k_end = k + 1
+        while (k_end < size_k and k_end + 1 - k <= max_volume
+               and not covered[i, j, k_end] and indices[i, j, k_end] == value):
+            k_end += 1
+        row = k_end - k
+
+        j_end = j + 1
+        while (j_end < size_j and (j_end + 1 - j) * row <= max_volume
+               and not covered[i, j_end, k:k_end].any() and (indices[i, j_end, k:k_end] == value).all()):
+            j_end += 1
+        layer = (j_end - j) * row
+
+        i_end = i + 1
+        while (i_end < size_i and (i_end + 1 - i) * layer <= max_volume
+               and not covered[i_end, j:j_end, k:k_end].any() and (indices[i_end, j:j_end, k:k_end] == value).all()):
+            i_end += 1
+
+        covered[i:i_end, j:j_end, k:k_end] = True
+        regions.append((i, j, k, i_end, j_end, k_end, int(value)))
+
+    return regions
+
+
+def split_regions(indices, solid, position, min_fill_volume=MIN_FILL_VOLUME):
+    """
+    Merges a volume with merge_regions and splits the boxes into fills and single blocks
+    :param indices: 3D array of palette indices
+    :param solid: 3D boolean mask of the blocks that need placing
+    :param position: function from (i, j, k) in the volume to the ivec3 world position
+    :param min_fill_volume: smallest box that becomes a fill
+    :return tuple: (fills, singles) with fills as (corner1, corner2, index) and singles as
+        layer j -> index -> list of positions
+    """
+    fills = []
+    singles = {}
+    for i, j, k, i_end, j_end, k_end, value in merge_regions(indices, solid):
+        if (i_end - i) * (j_end - j) * (k_end - k) >= min_fill_volume:
+            fills.append((position(i, j, k), position(i_end - 1, j_end - 1, k_end - 1), value))
+            continue
+        for di in range(i, i_end):
+            for dj in range(j, j_end):
+                for dk in range(k, k_end):
+                    singles.setdefault(dj, {}).setdefault(value, []).append(position(di, dj, dk))
+    return fills, singles
+
+
+def fill_command(corner1, corner2, block, mode=None):
+    # fill command for the box between two corners, mode is e.g. "replace minecraft:oak_leaves"
+    command = f"fill {corner1[0]} {corner1[1]} {corner1[2]} {corner2[0]} {corner2[1]} {corner2[2]} {block}"
+    return command if mode is None else f"{command} {mode}"
+
+
+def run_commands(editor, commands, batch_size=COMMAND_BATCH_SIZE):
+    # Sends commands batch_size lines per request
+    for i in range(0, len(commands), batch_size):
+        editor.runCommand("\n".join(commands[i: i + batch_size]))
+
+
+def place_volume(editor, start, schematic, min_fill_volume=MIN_FILL_VOLUME):
+    """
+    Places a whole rotated schematic at once. Air is skipped, boxes of identical blocks become fill
+    commands and the remaining blocks are sent grouped by block, bottom layer first
+    :param editor: editor instance
+    :param start: ivec3, Southeast bottom corner the schematic is built from
+    :param schematic: RotatedSchematic to place
+    :param min_fill_volume: smallest box that is sent as a fill command
+    :return dict: number of blocks, fill regions, blocks covered by fills and single placements
+    """
+    indices = schematic.indices
+    solid = ~schematic.air[indices]
+
+    def position(i, j, k):
+        return ivec3(start.x - i, start.y + j, start.z - k)
+
+    fills, singles = split_regions(indices, solid, position, min_fill_volume)
+
+    # Send earlier buffered blocks first so fills land on top of them, then the fills
+    if fills:
+        if editor.buffering:
+            editor.flushBuffer()
+        run_commands(editor, [fill_command(corner1, corner2, schematic.palette[value])
+                              for corner1, corner2, value in fills])
+
+    single_blocks = 0
+    for layer in sorted(singles):
+        for value, positions in singles[layer].items():
+            editor.placeBlock(positions, schematic.blocks[value])
+            single_blocks += len(positions)
+
+    filled_blocks = int(solid.sum()) - single_blocks
+    summary = {"blocks": int(solid.sum()), "fill_regions": len(fills), "filled_blocks": filled_blocks,
+               "single_blocks": single_blocks, "air_skipped": int(solid.size - solid.sum())}
+    print(f"Sent {summary['blocks']} blocks: {summary['fill_regions']} fill regions covering "
+          f"{filled_blocks} blocks, {single_blocks} single blocks")
+    return summary
+
+
+def build_structure(editor, plot: BuildingPlot, direction="east", bulk=False):
     """
     Reads schematic from file and builds structure into world. Structure builds in an order depending
     on which coordinates are used to create the schematic. End result is not affected.
@@ -151,6 +382,7 @@ def build_structure(editor, plot: BuildingPlot, direction="east"):
     :param filepath: name of file for which schematic you want to load
     :param plot: BuildingPlot, converted to ivec3, the Southeast (pos x, pos z) corner of the plot
     :param direction: String, direction building faces. East is default
+    :param bulk: place the structure with place_volume instead of block by block
     :return Structure:
     """
     start_time = time.time()
@@ -158,76 +390,33 @@ def build_structure(editor, plot: BuildingPlot, direction="east"):
     if schematic_path is None:
         print("Error: No schematic for biome:", plot.biome)
         sys.exit(1)
-    schematic = read_schematic_from_file(schematic_path)
-    door_found = False  # records first door found
-    door = None
-
-    # update rotation of structs and rotation mapping for blocks
-    if direction == "south":
-        schematic = np.rot90(schematic, axes=(0, 2))
-        facing_mapping = {"north": "east", "west": "north", "south": "west", "east": "south"}
-    if direction == "west":
-        schematic = np.flip(schematic, 0)
-        facing_mapping = {"north": "north", "west": "east", "south": "south", "east": "west"}
-    if direction == "north":
-        schematic = np.rot90(schematic, k=-1, axes=(0, 2))
-        facing_mapping = {"north": "west", "west": "south", "south": "east", "east": "north"}
+    # rotated structure with its blocks already parsed
+    schematic = load_rotated_schematic(schematic_path, direction)
+    indices = schematic.indices
 
     # converts plot to SE start coordinate
     start = ivec3((plot.x + plot.plot_len - 1), plot.y, (plot.z + plot.plot_len - 1))
-
-    x = start[0]
-    y = start[1]
-    z = start[2]
-    end = start
     #print("Start at,", start)
 
-    # builds structure in layers pos to neg X, each layer is built in rows from bottom to top, rows built pos to neg Z
-    for layer in schematic:
-        for row in layer:
-            for block in row:
-                if block == "air":  # skips to next block if air
-                    end = ivec3(x, y, z)  # keeps track of current latest placed block
-                    z = z - 1
-                    continue
-
-                # Extract block information
-                # print("BLOCK:", block)  # debug
-                block_info = block.split('[', 1)
-                block_name = block_info[0]
-                # print("INFO:", block_info)  # debug
-                block_properties = '[' + ''.join(block_info[1:]) if len(block_info) > 1 else ''
-                # print("PROPERTIES:", block_properties)  # debug
-
-                if not door_found and "_door" in block_name:  # finds door for road generation
-                    # print(f"Found door: {block},    coordinates", x, y, z) # debug
-                    door = ivec3(x, y - 1, z)  # pathing algorithm needs block beneath the door
-                    door_found = True
-
-                # Handle rotation of directional blocks
-                if direction != "east" and 'facing=' in block_properties:
-                    # Extract current facing direction and update properties
-
-                    properties_list = block_properties.strip('[]').split(',')
-                    for i, prop in enumerate(properties_list):
-                        if 'facing=' in prop:
-                            facing_info = prop.split('facing=')[1]
-                            facing_direction = facing_info.strip()
-                            updated_facing = facing_mapping.get(facing_direction, facing_direction)
-                            properties_list[i] = 'facing=' + updated_facing
-                            break  # Exit loop after updating facing property
-                    # Reconstruct block_properties string
-                    block_properties = '[' + ','.join(properties_list) + ']'
-
-                # Place the block with the updated information
-                editor.placeBlock(ivec3(x, y, z), Block(block_name + block_properties))
-                # print("placed", str(block_name + block_properties), "at ", x, y, z)  # debug
-
-                z = z - 1  # moves to next block in row
-            z = start[2]  # resets block
-            y = y + 1  # moves to next row in layer
-        y = start[1]  # resets row
-        x = x - 1  # moves to next layer in structure
+    # finds first door for road generation, pathing algorithm needs block beneath the door
+    door = None
+    if schematic.door_offset is not None:
+        i, j, k = schematic.door_offset
+        door = ivec3(start.x - i, start.y + j - 1, start.z - k)
+
+    # keeps track of the last air block in build order
+    end = start
+    if schematic.last_air_offset is not None:
+        i, j, k = schematic.last_air_offset
+        end = ivec3(start.x - i, start.y + j, start.z - k)
+
+    if bulk:
+        place_volume(editor, start, schematic)
+    else:
+        # builds structure in layers pos to neg X, each layer is built in rows from bottom to top, rows built pos to neg Z
+        blocks = schematic.blocks
+        for i, j, k in schematic.solid_offsets:
+            editor.placeBlock(ivec3(start.x - i, start.y + j, start.z - k), blocks[indices[i, j, k]])
 
     end_time = time.time()
     elapsed_time = end_time - start_time
@@ -5,6 +5,8 @@ Load and use a world slice.
 """
 
 import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 
@@ -14,7 +16,9 @@ from gdpc.vector_tools import addY
 from tqdm import tqdm
 from foundationPlacement import createFoundations
 from biome import biomes_dict
+from world_layers import water_mask, is_water
 from glm import ivec3
+from shared_arrays import SharedArrays, attach_shared
 
 
 class BuildingPlot:
@@ -42,10 +46,17 @@ class BuildingPlot:
     def get_z_range(self, padding=0):
         return range(self.z - padding, self.z + self.plot_len + padding)
 
-    def update_biome(self, editor):
-        biome_coord = ivec3(self.x, 100, self.z)
-        self.biome = editor.getBiome(biome_coord)
-        self.schematic_path = biomes_dict[self.biome]
+    def update_biome(self, editor, biome_map=None):
+        # Majority biome over the footprint when a biome map is available, one request otherwise
+        self.biome = None
+        if biome_map is not None:
+            self.biome = biome_map.majority(self.x, self.z, self.plot_len, self.plot_len)
+        # The map holds no biome for footprints outside the loaded area
+        if self.biome is None:
+            biome_coord = ivec3(self.x, 100, self.z)
+            self.biome = editor.getBiome(biome_coord)
+        # Biomes without a schematic leave the plot empty, like the ones mapped to None
+        self.schematic_path = biomes_dict.get(self.biome)
 
     def __lt__(self, other):
         return self.std < other.std
@@ -58,21 +69,54 @@ def check_overlap(plot1, plot2, padding=0):
     z_range2 = plot2.get_z_range(padding)
 
     # Check for overlap in x and z coordinates
-    overlap_x = any(x in x_range1 for x in x_range2) or any(x in x_range2 for x in x_range1)
-    overlap_z = any(z in z_range1 for z in z_range2) or any(z in z_range2 for z in z_range1)
+    overlap_x = x_range1.start < x_range2.stop and x_range2.start < x_range1.stop
+    overlap_z = z_range1.start < z_range2.stop and z_range2.start < z_range1.stop
 
     return overlap_x and overlap_z
 
 
 def filter_overlapping_plots(building_plots, padding):
-    filtered_plots = []
-
-    for current_plot in building_plots:
-        # Check if current_plot overlaps with any plot in filtered_plots
-        if not any(check_overlap(current_plot, previous_plot, padding) for previous_plot in filtered_plots):
-            filtered_plots.append(current_plot)
-
-    return filtered_plots
+    x_offsets = [plot.x for plot in building_plots]
+    z_offsets = [plot.z for plot in building_plots]
+    sizes = [plot.plot_len for plot in building_plots]
+
+    kept = select_non_overlapping(x_offsets, z_offsets, sizes, padding)
+
+    return [building_plots[i] for i in kept]
+
+
+def select_non_overlapping(x_offsets, z_offsets, sizes, padding):
+    """
+    Greedily keeps square plots that do not overlap any plot kept before them. Kept plots are marked
+    in a boolean occupancy grid, so every check costs the same no matter how many plots were kept
+    :param x_offsets: x coordinate of every plot, in priority order
+    :param z_offsets: z coordinate of every plot, in priority order
+    :param sizes: side length of every plot, or one side length for all of them
+    :param padding: padding around every plot that may not overlap either
+    :return list: indices of the kept plots, in priority order
+    """
+    x_offsets = np.asarray(x_offsets, dtype=np.int64)
+    z_offsets = np.asarray(z_offsets, dtype=np.int64)
+    sizes = np.broadcast_to(np.asarray(sizes, dtype=np.int64), x_offsets.shape)
+    if len(x_offsets) == 0:
+        return []
+
+    # Grid covering the padded footprints of all plots
+    low_x = int(x_offsets.min()) - padding
+    low_z = int(z_offsets.min()) - padding
+    occupied = np.zeros((int((x_offsets + sizes).max()) + padding - low_x,
+                         int((z_offsets + sizes).max()) + padding - low_z), dtype=bool)
+
+    kept = []
+    for i, (x, z, size) in enumerate(zip((x_offsets - padding - low_x).tolist(),
+                                         (z_offsets - padding - low_z).tolist(), sizes.tolist())):
+        # Padded footprints overlap exactly when they share a cell of the grid
+        footprint = occupied[x: x + size + 2 * padding, z: z + size + 2 * padding]
+        if not footprint.any():
+            footprint[:] = True
+            kept.append(i)
+
+    return kept
 
 
 def build_outline(editor, negative_corner, positive_corner, block, y):
@@ -95,54 +139,293 @@ def build_outline(editor, negative_corner, positive_corner, block, y):
     editor.placeBlock(positive_corner, Block("blue_concrete"))
 
 
-def map_water(editor, begin, end, heightmap):
+def map_water(editor, begin, end, heightmap, world_slice=None):
+    # With a loaded world slice the whole water map is read in one vectorized pass
+    if world_slice is not None:
+        return water_mask(world_slice, heightmap)
+
     # Create an array of zeroes with the same dimensions as heightmap
     water_array = np.zeros_like(heightmap)
 
-    # Loop over every 3 rows to estimate water percentage
-    total_iterations = (end.x - begin.x) // 3
-    for x in tqdm(range(begin.x, end.x, 3), total=total_iterations):
+    # Loop over every column of the build area
+    for x in tqdm(range(begin.x, end.x), total=end.x - begin.x):
         for z in range(begin.z, end.z):
 
             # Get top block
             block = editor.getBlock((x, heightmap[x - begin.x, z - begin.z] - 1, z))
 
             # Set a location to 1 if top block is water
-            if "water" in str(block):
+            if is_water(str(block)):
                 water_array[(x - begin.x)][(z - begin.z)] = 1
 
     return water_array
 
 
-def find_settlement_location(begin, water_array, heightmap):
+def integral_image(array):
+    """
+    Builds a summed-area table with a leading row and column of zeros
+    :param array: 2D array to sum
+    :return numpy array: int64 table where table[x, z] is the sum of array[:x, :z]
+    """
+    table = np.zeros((array.shape[0] + 1, array.shape[1] + 1), dtype=np.int64)
+    np.cumsum(np.cumsum(array, axis=0, dtype=np.int64), axis=1, out=table[1:, 1:])
+    return table
+
+
+def window_sums(table, size):
+    """
+    Sums every size x size window of the array a summed-area table was built from
+    :param table: table from integral_image
+    :param size: side length of the window
+    :return numpy array: window sums indexed by the window's (x, z) offset
+    """
+    return table[size:, size:] - table[:-size, size:] - table[size:, :-size] + table[:-size, :-size]
+
+
+def window_statistics(heightmap, water_array, size):
+    """
+    Scores every size x size window at once, each window costs O(1) thanks to summed-area tables
+    :param heightmap: 2D height array
+    :param water_array: 2D water map, 1 where there is water
+    :param size: side length of the window
+    :return tuple: (variance, water) arrays indexed by window offset. variance is size^4 times the
+        height variance, kept as exact integers so windows with equal std compare equal
+    """
+    heights = np.asarray(heightmap, dtype=np.int64)
+    sums = window_sums(integral_image(heights), size)
+    squares = window_sums(integral_image(heights * heights), size)
+    water = window_sums(integral_image(np.asarray(water_array) == 1), size)
+    return size * size * squares - sums * sums, water
+
+
+def window_std(variance, size):
+    # Converts the integer variance from window_statistics to a standard deviation
+    return np.sqrt(variance) / (size * size)
+
+
+def exhaustive_offset(heightmap, water_array, plot_size, step, max_water_percentage):
+    """
+    Finds the flattest plot with acceptable water percentage by scoring every offset
+    :return tuple: (x, z) offset of the plot, (0, 0) if no plot has an acceptable water percentage
+    """
+    size_x, size_z = np.shape(heightmap)
+    best = score_tile(heightmap, water_array, plot_size, step, max_water_percentage,
+                      0, size_x - plot_size + 1, 0, size_z - plot_size + 1)
+
+    # Falls back to the first plot if no plot has an acceptable water percentage
+    if best is None:
+        return 0, 0
+    return best[1], best[2]
+
+
+def score_tile(heightmap, water_array, plot_size, step, max_water_percentage, x_begin, x_end, z_begin, z_end):
+    """
+    Finds the flattest plot with acceptable water percentage among the offsets of one tile
+    :param x_begin: first x offset of the tile, a multiple of step
+    :param x_end: end of the x offsets, exclusive
+    :param z_begin: first z offset of the tile, a multiple of step
+    :param z_end: end of the z offsets, exclusive
+    :return tuple: (variance, x, z) of the best plot, None if the tile has no acceptable plot
+    """
+    if x_end <= x_begin or z_end <= z_begin:
+        return None
+
+    # Score every plot offset at once, only the part of the maps the tile's plots cover is read
+    crop = (slice(x_begin, x_end - 1 + plot_size), slice(z_begin, z_end - 1 + plot_size))
+    variance, water = window_statistics(heightmap[crop], water_array[crop], plot_size)
+    variance = variance[::step, ::step]
+    water_percentage = water[::step, ::step] / (plot_size * plot_size) * 100
+    valid = water_percentage < max_water_percentage
+    if not valid.any():
+        return None
+
+    # argmin keeps the first of equal scores, the lowest x and then the lowest z
+    scores = np.where(valid, variance, np.iinfo(np.int64).max)
+    x_offset, z_offset = np.unravel_index(np.argmin(scores), scores.shape)
+    return int(variance[x_offset, z_offset]), x_begin + int(x_offset) * step, z_begin + int(z_offset) * step
+
+
+def tiled_offset(heightmap, water_array, plot_size, step, max_water_percentage, workers=None, tile_size=512):
+    """
+    exhaustive_offset split into tiles of offsets, scored in a process pool. Neighboring tiles read
+    maps overlapping by the plot size, the maps are put in shared memory once instead of being sent
+    with every tile. Reducing the tile bests by (variance, x, z) gives the same plot as the serial search
+    :param workers: number of processes, the tiles are scored in this process when None or 1
+    :param tile_size: side length of a tile in offsets, rounded down to a multiple of step
+    :return tuple: (x, z) offset of the plot, (0, 0) if no plot has an acceptable water percentage
+    """
+    size_x, size_z = np.shape(heightmap)
+    tile_size = max(tile_size // step, 1) * step
+    tiles = [(x, min(x + tile_size, size_x - plot_size + 1), z, min(z + tile_size, size_z - plot_size + 1))
+             for x in range(0, size_x - plot_size + 1, tile_size)
+             for z in range(0, size_z - plot_size + 1, tile_size)]
+    settings = (plot_size, step, max_water_percentage)
+
+    if workers is not None and workers > 1 and len(tiles) > 1:
+        arrays = {"heightmap": np.asarray(heightmap, dtype=np.int64), "water": np.asarray(water_array)}
+        with SharedArrays(arrays) as shared:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_attach_tile_maps,
+                                     initargs=(shared.layouts,)) as pool:
+                bests = list(pool.map(_score_shared_tile, [settings + tile for tile in tiles]))
+    else:
+        bests = [score_tile(heightmap, water_array, *settings, *tile) for tile in tiles]
+
+    bests = [best for best in bests if best is not None]
+    if not bests:
+        return 0, 0
+    _, x_offset, z_offset = min(bests)
+    return x_offset, z_offset
+
+
+# Maps of a tile worker process, set once by _attach_tile_maps
+_tile_maps = {}
+
+
+def _attach_tile_maps(layouts):
+    _tile_maps.update(attach_shared(layouts))
+
+
+def _score_shared_tile(task):
+    return score_tile(_tile_maps["heightmap"], _tile_maps["water"], *task)
+
+
+def block_sums(array):
+    """
+    Sums 2x2 blocks of an array, a last row or column that does not fill a block is dropped
+    :param array: 2D array
+    :return numpy array: int64 array of block sums, half the size of array
+    """
+    size_x, size_z = array.shape[0] // 2 * 2, array.shape[1] // 2 * 2
+    array = np.asarray(array, dtype=np.int64)
+    # Adding four strided views is much faster than summing a reshaped array over two axes
+    return (array[0:size_x:2, 0:size_z:2] + array[1:size_x:2, 0:size_z:2]
+            + array[0:size_x:2, 1:size_z:2] + array[1:size_x:2, 1:size_z:2])
+
+
+def score_neighborhoods(level, factor, plot_size, candidates, radius):
+    """
+    Scores the plots within radius of every candidate offset at one pyramid level
+    :param level: (heights, squares, water) block sum arrays of the level
+    :param factor: blocks of the level are factor x factor columns
+    :param plot_size: side length of the plot in columns
+    :param candidates: (x, z) offsets in level coordinates
+    :param radius: offsets up to radius cells away from a candidate are scored
+    :return tuple: (variance, water, x, z) arrays, one entry per distinct offset. variance and water
+        are scaled like window_statistics, exact at level 0 and approximations above it
+    """
+    heights, squares, water = level
+    window = plot_size // factor
+    cells = (window * factor) ** 2
+    max_x, max_z = heights.shape[0] - window, heights.shape[1] - window
+    results = []
+    for x, z in candidates:
+        x0, x1 = max(x - radius, 0), min(x + radius, max_x)
+        z0, z1 = max(z - radius, 0), min(z + radius, max_z)
+        if x0 > x1 or z0 > z1:
+            continue
+
+        # Summed-area tables of just the part of the level these windows cover
+        crop = (slice(x0, x1 + window), slice(z0, z1 + window))
+        sums = window_sums(integral_image(heights[crop]), window)
+        square_sums = window_sums(integral_image(squares[crop]), window)
+        water_sums = window_sums(integral_image(water[crop]), window)
+        offsets_x, offsets_z = np.meshgrid(np.arange(x0, x1 + 1), np.arange(z0, z1 + 1), indexing="ij")
+        results.append(np.stack([(cells * square_sums - sums * sums).ravel(),
+                                 (water_sums * (plot_size * plot_size) // cells).ravel(),
+                                 offsets_x.ravel(), offsets_z.ravel()]))
+
+    if not results:
+        return tuple(np.empty(0, dtype=np.int64) for _ in range(4))
+
+    # Neighborhoods of close candidates overlap, every offset is kept once
+    results = np.concatenate(results, axis=1)
+    if len(candidates) > 1:
+        _, first = np.unique(results[2] * (max_z + 1) + results[3], return_index=True)
+        results = results[:, first]
+    return tuple(results)
+
+
+def pyramid_offset(heightmap, water_array, plot_size, max_water_percentage, levels=3, top_k=8, radius=2):
+    """
+    Coarse-to-fine version of exhaustive_offset for large areas. The heightmap and water map are
+    summed into 2x2 blocks once per level. Every plot is scored on the coarsest level, and on each finer level
+    only the neighborhoods of the top_k plots of the level above are scored. On the full resolution
+    level scores are exact, so the result is the exhaustive answer whenever it survives into the top_k
+    :param levels: number of downsampled levels, 0 gives the exhaustive search
+    :param top_k: plots kept per level, the accuracy / speed knob
+    :param radius: neighborhood around every kept plot scored on the next level, in cells of that level
+    :return tuple: (x, z) offset of the plot
+    """
+    # Level l holds sums over 2^l x 2^l columns, stopping while a plot still spans a few blocks
+    heights = np.asarray(heightmap, dtype=np.int64)
+    pyramid = [(heights, heights * heights, (np.asarray(water_array) == 1).astype(np.int64))]
+    while len(pyramid) <= levels and plot_size // 2 ** len(pyramid) >= 4:
+        pyramid.append(tuple(block_sums(array) for array in pyramid[-1]))
+
+    # The coarsest level is scored everywhere: one neighborhood around (0, 0) that reaches every offset
+    top = len(pyramid) - 1
+    candidates = [(0, 0)]
+
+    for level in range(top, -1, -1):
+        level_radius = max(pyramid[level][0].shape) if level == top else radius
+        variance, water, x, z = score_neighborhoods(pyramid[level], 2 ** level, plot_size, candidates, level_radius)
+        valid = water / (plot_size * plot_size) * 100 < max_water_percentage
+        if not valid.any():
+            # Nothing acceptable was found around the candidates, the exhaustive search decides
+            return exhaustive_offset(heightmap, water_array, plot_size, 1, max_water_percentage)
+
+        # Lowest variance first, ties go to the lowest offset like argmin in the exhaustive search
+        variance, x, z = variance[valid], x[valid], z[valid]
+        best = np.lexsort((z, x, variance))[:top_k]
+        if level == 0:
+            return int(x[best[0]]), int(z[best[0]])
+
+        # A cell of this level is 2x2 cells of the next one
+        candidates = [(int(x[i]) * 2, int(z[i]) * 2) for i in best]
+
+
+def compare_settlement_search(heightmap, water_array, plot_size=100, max_water_percentage=.7, levels=3, top_k=8):
+    """
+    Runs the pyramid and the exhaustive search on the same area and reports how far apart they are
+    :return dict: both offsets with their standard deviation and runtime, the difference in standard
+        deviation and the distance between the offsets
+    """
+    report = {}
+    for name, search in (("exhaustive", lambda: exhaustive_offset(heightmap, water_array, plot_size, 1,
+                                                                  max_water_percentage)),
+                         ("pyramid", lambda: pyramid_offset(heightmap, water_array, plot_size,
+                                                            max_water_percentage, levels, top_k))):
+        start = time.perf_counter()
+        x_offset, z_offset = search()
+        seconds = time.perf_counter() - start
+        plot = heightmap[x_offset: x_offset + plot_size, z_offset: z_offset + plot_size]
+        report[name] = {"offset": (x_offset, z_offset), "std": float(np.std(plot)), "seconds": seconds}
+
+    report["std_error"] = report["pyramid"]["std"] - report["exhaustive"]["std"]
+    report["distance"] = float(np.hypot(*np.subtract(report["pyramid"]["offset"], report["exhaustive"]["offset"])))
+    return report
+
+
+def find_settlement_location(begin, water_array, heightmap, pyramid_levels=0, top_k=8, workers=None):
     # Hyperparameters
     plot_size = 100
     step = 1
     max_water_percentage = .7
 
-    # Variable declaration
-    lowest_std = sys.maxsize
-    plot = heightmap[0: plot_size, 0: plot_size]
-    std = np.std(plot)
-    best_plot_water = water_array[0: plot_size, 0: plot_size]
-    best_plot = BuildingPlot(plot, begin.x, begin.z, std)
-
-    # Iterate over building area with step and search for plots
-    for x_offset in range(0, len(heightmap) - plot_size + 1, step):
-        for z_offset in range(0, len(heightmap[0]) - plot_size + 1, step):
-
-            # Extract a potential plot, get std and water_percentage
-            plot = heightmap[x_offset: x_offset + plot_size, z_offset: z_offset + plot_size]
-            std = np.std(plot)
-            water_plot = water_array[x_offset: x_offset + plot_size, z_offset: z_offset + plot_size]
-            water_percentage = 3 * np.count_nonzero(water_plot == 1) / water_plot.size * 100
-
-            # If there is a new lowest std and acceptable water percentage, new best plot found
-            if std < lowest_std and water_percentage < max_water_percentage:
-                print("new best plot found with std:", std)
-                lowest_std = std
-                best_plot = BuildingPlot(plot, begin.x + x_offset, begin.z + z_offset, std)
-                best_plot_water = water_plot
+    # pyramid_levels > 0 trades exactness for speed on large areas, see pyramid_offset. workers > 1
+    # spreads the exact search over several processes, see tiled_offset
+    if pyramid_levels > 0:
+        x_offset, z_offset = pyramid_offset(heightmap, water_array, plot_size, max_water_percentage,
+                                            pyramid_levels, top_k)
+    elif workers is not None and workers > 1:
+        x_offset, z_offset = tiled_offset(heightmap, water_array, plot_size, step, max_water_percentage, workers)
+    else:
+        x_offset, z_offset = exhaustive_offset(heightmap, water_array, plot_size, step, max_water_percentage)
+
+    plot = heightmap[x_offset: x_offset + plot_size, z_offset: z_offset + plot_size]
+    best_plot_water = water_array[x_offset: x_offset + plot_size, z_offset: z_offset + plot_size]
+    best_plot = BuildingPlot(plot, begin.x + x_offset, begin.z + z_offset, np.std(plot))
+    print("best plot found with std:", best_plot.std)
 
     # Define corners for new plot
     y = 150
@@ -152,35 +435,35 @@ def find_settlement_location(begin, water_array, heightmap):
     return best_plot, best_plot_water, negative, positive
 
 
-def find_building_locations(editor, settlement_plot, settlement_water, negative):
+def find_building_locations(editor, settlement_plot, settlement_water, negative, biome_map=None):
     # Hyperparameters
     building_size = 9
     step = 1
+    padding = 3
 
-    # Variable declaration
-    building_plots = []
-
-    # Iterate over building area with step and search for plots
-    for x_offset in range(0, settlement_plot.plot_len - building_size + 1, step):
-        for z_offset in range(0, settlement_plot.plot_len - building_size + 1, step):
+    # Score every building plot at once and keep the ones without water
+    variance, water = window_statistics(settlement_plot.plot, settlement_water, building_size)
+    variance = variance[::step, ::step]
+    dry = water[::step, ::step] == 0
+    x_offsets, z_offsets = np.nonzero(dry)
+    candidate_variance = variance[dry]
 
-            # Extract a potential plot, get std and water_percentage
-            plot = settlement_plot.plot[x_offset: x_offset + building_size, z_offset: z_offset + building_size]
-            std = np.std(plot)
-            water_plot = settlement_water[x_offset: x_offset + building_size, z_offset: z_offset + building_size]
-            water_percentage = np.count_nonzero(water_plot == 1) / water_plot.size * 100
+    # Sort plots by standard deviation (stable, so ties keep scan order) and filter overlapping plots
+    order = np.argsort(candidate_variance, kind="stable")
+    x_offsets = x_offsets[order] * step
+    z_offsets = z_offsets[order] * step
+    kept = select_non_overlapping(x_offsets, z_offsets, building_size, padding)
 
-            # If there is no water
-            if water_percentage == 0:
-                new_plot = BuildingPlot(plot, negative[0] + x_offset, negative[2] + z_offset, std)
-                building_plots.append(new_plot)
+    # Only the plots that survived filtering become BuildingPlots
+    building_plots = []
+    for i in kept:
+        x_offset, z_offset = int(x_offsets[i]), int(z_offsets[i])
+        plot = settlement_plot.plot[x_offset: x_offset + building_size, z_offset: z_offset + building_size]
+        std = float(window_std(candidate_variance[order[i]], building_size))
+        building_plots.append(BuildingPlot(plot, negative[0] + x_offset, negative[2] + z_offset, std))
 
-    # Sort plots by standard deviation and filter overlapping plots
-    padding = 3
-    building_plots = sorted(building_plots)
-    building_plots = filter_overlapping_plots(building_plots, padding)
     for plot in building_plots:
-        plot.update_biome(editor)
+        plot.update_biome(editor, biome_map)
 
     return building_plots
 
@@ -192,7 +475,7 @@ def place_outlines(editor, building_plots, negative, positive):
 
     y = 150
 
-    build_outline(negative, positive, diamond, y)
+    build_outline(editor, negative, positive, diamond, y)
 
     for plot in building_plots:
         negative_corner = (plot.x, y, plot.z)
@@ -0,0 +1,59 @@
+"""
+Numpy arrays in shared memory, so process pool workers can read large inputs (heightmaps, masks)
+without a pickled copy per task.
+"""
+
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# Blocks attached in this process, kept referenced so their buffers stay valid
+_attached = []
+
+
+class SharedArrays:
+    """Copies of numpy arrays in shared memory blocks, released when the context exits"""
+
+    def __init__(self, arrays):
+        """
+        :param arrays: dict from name to numpy array
+        """
+        self.blocks = {}
+        self.layouts = {}
+        try:
+            for name, array in arrays.items():
+                array = np.ascontiguousarray(array)
+                block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+                self.blocks[name] = block
+                np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+                self.layouts[name] = (block.name, array.shape, array.dtype.str)
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        for block in self.blocks.values():
+            block.close()
+            block.unlink()
+        self.blocks = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def attach_shared(layouts):
+    """
+    Maps the arrays of a SharedArrays into this process, meant for pool initializers
+    :param layouts: SharedArrays.layouts
+    :return dict: name to read-only numpy array backed by the shared block
+    """
+    arrays = {}
+    for name, (block_name, shape, dtype) in layouts.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        _attached.append(block)
+        arrays[name] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+        arrays[name].flags.writeable = False
+    return arrays
@@ -0,0 +1,132 @@
+"""
+On-disk cache of the terrain layers of a build area, so reruns on an unchanged area skip loading
+the world slice and mapping water and biomes.
+
+Every entry is a directory named after the world and the build area bounds. It holds one .npy file
+per layer, loaded memory-mapped, and a meta.json with the palettes and the world fingerprint. The
+fingerprint hashes the WORLD_SURFACE, OCEAN_FLOOR and MOTION_BLOCKING_NO_LEAVES heightmaps, three
+small requests instead of a world slice. Any change of height rebuilds the entry, and so does water
+turning into land or ice and land turning into water, since the heightmaps then stop agreeing.
+
+A block swapped for another at the same height with the same heightmap behaviour (grass_block to
+dirt_path, stone to cobblestone, ...) does not change the fingerprint. main.py therefore removes the
+entry of the build area after every run that placed blocks in it. After editing the area by hand,
+use TerrainCache.invalidate (--invalidate-cache) to rebuild the entry.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from gdpc import interface
+
+from world_layers import TerrainLayers
+
+CACHE_DIRECTORY = ".terrain_cache"
+CACHE_VERSION = 2
+# Heightmaps hashed into the world fingerprint, together they change when water and land trade places
+FINGERPRINT_HEIGHTMAPS = ("WORLD_SURFACE", "OCEAN_FLOOR", "MOTION_BLOCKING_NO_LEAVES")
+
+
+def world_fingerprint(editor, rect, heightmap_types=FINGERPRINT_HEIGHTMAPS):
+    """
+    Hashes the heightmaps of an area, a few small requests instead of a whole world slice
+    :param editor: editor instance
+    :param rect: gdpc Rect of the area
+    :param heightmap_types: heightmaps to hash
+    :return String: hex digest
+    """
+    position, size = (rect.offset.x, 0, rect.offset.y), (rect.size.x, 0, rect.size.y)
+    digest = hashlib.sha256()
+    for heightmap_type in heightmap_types:
+        if hasattr(editor, "getHeightmap"):
+            heightmap = editor.getHeightmap(position, size, heightmap_type)
+        else:
+            heightmap = interface.getHeightmap(position, size, heightmap_type, dimension=editor.dimension,
+                                               retries=editor.retries, timeout=editor.timeout, host=editor.host)
+        heightmap = np.ascontiguousarray(heightmap, dtype="<i8")
+        digest.update(heightmap_type.encode() + str(heightmap.shape).encode() + heightmap.tobytes())
+    return digest.hexdigest()
+
+
+class TerrainCache:
+    """Directory of cached TerrainLayers, one entry per world and build area"""
+
+    def __init__(self, directory=CACHE_DIRECTORY, world="default"):
+        """
+        :param directory: where entries are stored
+        :param world: name of the world (e.g. the editor host), part of every entry name
+        """
+        self.directory = directory
+        self.world = world
+
+    def entry_path(self, rect):
+        # Directory of the entry for a build area
+        world = hashlib.sha1(self.world.encode()).hexdigest()[:8]
+        return os.path.join(self.directory, f"{world}_{rect.offset.x}_{rect.offset.y}_{rect.size.x}_{rect.size.y}")
+
+    def load(self, rect, fingerprint):
+        """
+        Loads the layers of a build area if they were stored for the same world state
+        :param rect: gdpc Rect of the build area
+        :param fingerprint: current world_fingerprint of the area
+        :return TerrainLayers: memory-mapped, read-only layers, None on a miss or a changed world
+        """
+        path = self.entry_path(rect)
+        try:
+            with open(os.path.join(path, "meta.json"), 'r') as file:
+                meta = json.load(file)
+        except (OSError, ValueError):
+            return None
+        if meta.get("version") != CACHE_VERSION or meta.get("fingerprint") != fingerprint:
+            return None
+
+        def array(name):
+            return np.load(os.path.join(path, name + ".npy"), mmap_mode='r')
+
+        heightmaps = {name: array("heightmap_" + name) for name in meta["heightmaps"]}
+        return TerrainLayers(rect, heightmaps, meta["surface_palette"], array("surface_ids"), array("water"),
+                             meta["biome_palette"], array("biome_ids"))
+
+    def store(self, rect, fingerprint, layers):
+        """
+        Writes the layers of a build area, replacing an older entry
+        :param rect: gdpc Rect of the build area
+        :param fingerprint: world_fingerprint of the area the layers were read from
+        :param layers: TerrainLayers to store
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.entry_path(rect)
+
+        # Written next to the entry and swapped in, so a crash never leaves half an entry behind
+        staging = tempfile.mkdtemp(dir=self.directory)
+        try:
+            arrays = {"surface_ids": layers.surface_ids, "water": layers.water, "biome_ids": layers.biome_ids}
+            arrays.update({"heightmap_" + name: heightmap for name, heightmap in layers.heightmaps.items()})
+            for name, values in arrays.items():
+                np.save(os.path.join(staging, name + ".npy"), np.asarray(values))
+            meta = {"version": CACHE_VERSION, "fingerprint": fingerprint, "world": self.world,
+                    "bounds": [rect.offset.x, rect.offset.y, rect.size.x, rect.size.y],
+                    "heightmaps": list(layers.heightmaps), "surface_palette": list(layers.surface_palette),
+                    "biome_palette": list(layers.biome_palette)}
+            with open(os.path.join(staging, "meta.json"), 'w') as file:
+                json.dump(meta, file)
+
+            if os.path.exists(path):
+                shutil.rmtree(path)
+            os.replace(staging, path)
+        except Exception:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+
+    def invalidate(self, rect=None):
+        """
+        Removes the entry of a build area, or every entry when rect is None
+        :param rect: gdpc Rect of the build area
+        """
+        path = self.directory if rect is None else self.entry_path(rect)
+        if os.path.exists(path):
+            shutil.rmtree(path)
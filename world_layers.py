@@ -0,0 +1,386 @@
+"""
+Bulk readers for a loaded WorldSlice. The chunk sections inside the slice are decoded straight into
+numpy arrays, so whole layers of the world (surface blocks, water, ...) can be read in one pass
+instead of with one getBlock request per block.
+"""
+
+import numpy as np
+from gdpc import Block, Rect
+
+
+class Section:
+    """A 16x16x16 chunk section of a WorldSlice, in global section coordinates"""
+
+    def __init__(self, x, y, z, palette_tag, data_tag, biome_palette_tag=None, biome_data_tag=None):
+        self.x = x
+        self.y = y
+        self.z = z
+        self.palette_tag = palette_tag
+        self.data_tag = data_tag
+        self.biome_palette_tag = biome_palette_tag
+        self.biome_data_tag = biome_data_tag
+        self._states = None
+        self._indices = None
+        self._biome_indices = None
+
+    @property
+    def states(self):
+        # Block state strings of the palette, formatted like str(Block)
+        if self._states is None:
+            self._states = [str(Block.fromBlockStateTag(tag)) for tag in self.palette_tag]
+        return self._states
+
+    @property
+    def indices(self):
+        # Palette index of every block in the section, indexed [y, z, x]
+        if self._indices is None:
+            if self.data_tag is None:
+                self._indices = np.zeros((16, 16, 16), dtype=np.uint16)
+            else:
+                bits = max(4, int(np.ceil(np.log2(len(self.palette_tag)))))
+                self._indices = unpack_bit_array(self.data_tag, bits, 4096).reshape(16, 16, 16)
+        return self._indices
+
+    @property
+    def biomes(self):
+        # Biome ids of the biome palette, None when the section has no biome data
+        if self.biome_palette_tag is None:
+            return None
+        return [str(tag.value) for tag in self.biome_palette_tag]
+
+    @property
+    def biome_indices(self):
+        # Biome palette index of every 4x4x4 cell of the section, indexed [y, z, x]
+        if self._biome_indices is None:
+            if self.biome_data_tag is None:
+                self._biome_indices = np.zeros((4, 4, 4), dtype=np.uint16)
+            else:
+                bits = max(1, int(np.ceil(np.log2(len(self.biome_palette_tag)))))
+                self._biome_indices = unpack_bit_array(self.biome_data_tag, bits, 64).reshape(4, 4, 4)
+        return self._biome_indices
+
+
+def unpack_bit_array(longs, bits_per_entry, size):
+    """
+    Decodes a Minecraft packed long array (1.16+ layout, entries never span two longs)
+    :param longs: the signed 64-bit values of the long array tag
+    :param bits_per_entry: number of bits used by each entry
+    :param size: number of entries stored in the array
+    :return numpy array: the decoded entries as uint16
+    """
+    entries_per_long = 64 // bits_per_entry
+    longs = np.asarray(longs, dtype=np.int64).view(np.uint64)
+    shifts = np.arange(entries_per_long, dtype=np.uint64) * np.uint64(bits_per_entry)
+    entries = (longs[:, None] >> shifts[None, :]) & np.uint64((1 << bits_per_entry) - 1)
+    return entries.reshape(-1)[:size].astype(np.uint16)
+
+
+def iter_sections(world_slice):
+    """
+    Yields every non-empty chunk section stored in a WorldSlice
+    :param world_slice: loaded gdpc WorldSlice, or a LocalWorldSlice which provides its own sections
+    :return generator of Section:
+    """
+    if hasattr(world_slice, "sections"):
+        yield from world_slice.sections()
+        return
+
+    chunk_rect = world_slice.chunkRect
+    chunks = world_slice.nbt["Chunks"]
+
+    for chunk_z in range(chunk_rect.size.y):
+        for chunk_x in range(chunk_rect.size.x):
+            # Same chunk ordering as gdpc uses when it builds the WorldSlice
+            chunk_tag = chunks[chunk_x + chunk_z * chunk_rect.size.x]
+            for section_tag in chunk_tag["sections"]:
+                if "block_states" not in section_tag or len(section_tag["block_states"]) == 0:
+                    continue
+                block_states = section_tag["block_states"]
+                data_tag = block_states["data"] if "data" in block_states else None
+                biome_palette_tag, biome_data_tag = None, None
+                if "biomes" in section_tag:
+                    biome_palette_tag = section_tag["biomes"]["palette"]
+                    if "data" in section_tag["biomes"]:
+                        biome_data_tag = section_tag["biomes"]["data"]
+                yield Section(chunk_rect.offset.x + chunk_x, int(section_tag["Y"].value),
+                              chunk_rect.offset.y + chunk_z, block_states["palette"], data_tag,
+                              biome_palette_tag, biome_data_tag)
+
+
+def section_window(rect, section):
+    """
+    Returns the part of the rect covered by a section's columns
+    :return tuple: (x slice, z slice) into rect-local arrays and (x, z) origin of the section in rect-local space
+    """
+    origin_x = section.x * 16 - rect.offset.x
+    origin_z = section.z * 16 - rect.offset.y
+    x_slice = slice(max(origin_x, 0), min(origin_x + 16, rect.size.x))
+    z_slice = slice(max(origin_z, 0), min(origin_z + 16, rect.size.y))
+    return x_slice, z_slice, origin_x, origin_z
+
+
+def palette_mapping(entries, palette, palette_ids):
+    """
+    Maps the palette of a section onto a shared palette, adding entries that are new
+    :param entries: palette of the section, its block states or its biomes
+    :param palette: shared list of block states or biomes, extended in place
+    :param palette_ids: dict from entry to its index in palette, extended in place
+    :return numpy array: shared palette index of every section palette entry
+    """
+    mapping = np.empty(len(entries), dtype=np.int32)
+    for i, entry in enumerate(entries):
+        if entry not in palette_ids:
+            palette_ids[entry] = len(palette)
+            palette.append(entry)
+        mapping[i] = palette_ids[entry]
+    return mapping
+
+
+def surface_states(world_slice, heightmap, offset=-1):
+    """
+    Reads the block state of every column at heightmap + offset in one pass over the WorldSlice
+    :param world_slice: loaded gdpc WorldSlice
+    :param heightmap: heightmap array of the slice, indexed [x, z]
+    :param offset: y offset from the heightmap, -1 gives the top block
+    :return tuple: (palette, ids) where palette is a list of block state strings and ids holds the
+        palette index of every column, -1 where the position is outside the loaded sections
+    """
+    rect = world_slice.rect
+    column_y = np.asarray(heightmap) + offset
+    ids = np.full(column_y.shape, -1, dtype=np.int32)
+    palette = []
+    palette_ids = {}
+
+    for section in iter_sections(world_slice):
+        x_slice, z_slice, origin_x, origin_z = section_window(rect, section)
+        window_y = column_y[x_slice, z_slice]
+        in_section = (window_y >> 4) == section.y
+        if not in_section.any():
+            continue
+
+        mapping = palette_mapping(section.states, palette, palette_ids)
+        local_x, local_z = np.nonzero(in_section)
+        section_ids = section.indices[window_y[local_x, local_z] & 15,
+                                      local_z + z_slice.start - origin_z,
+                                      local_x + x_slice.start - origin_x]
+        ids[local_x + x_slice.start, local_z + z_slice.start] = mapping[section_ids]
+
+    return palette, ids
+
+
+def surface_biomes(world_slice, heightmap, offset=-1):
+    """
+    Reads the biome of every column at heightmap + offset in one pass over the WorldSlice
+    :param world_slice: loaded gdpc WorldSlice
+    :param heightmap: heightmap array of the slice, indexed [x, z]
+    :param offset: y offset from the heightmap, -1 gives the biome at the top block
+    :return tuple: (palette, ids) where palette is a list of biome ids and ids holds the palette index
+        of every column, -1 where the position is outside the loaded sections
+    """
+    rect = world_slice.rect
+    column_y = np.asarray(heightmap) + offset
+    ids = np.full(column_y.shape, -1, dtype=np.int32)
+    palette = []
+    palette_ids = {}
+
+    for section in iter_sections(world_slice):
+        biomes = section.biomes
+        if biomes is None:
+            continue
+        x_slice, z_slice, origin_x, origin_z = section_window(rect, section)
+        window_y = column_y[x_slice, z_slice]
+        in_section = (window_y >> 4) == section.y
+        if not in_section.any():
+            continue
+
+        mapping = palette_mapping(biomes, palette, palette_ids)
+
+        # Biomes are stored per 4x4x4 cell
+        local_x, local_z = np.nonzero(in_section)
+        section_ids = section.biome_indices[(window_y[local_x, local_z] & 15) >> 2,
+                                            (local_z + z_slice.start - origin_z) >> 2,
+                                            (local_x + x_slice.start - origin_x) >> 2]
+        ids[local_x + x_slice.start, local_z + z_slice.start] = mapping[section_ids]
+
+    return palette, ids
+
+
+def block_from_state(state):
+    """
+    Parses a block state string like 'minecraft:oak_stairs[facing=north]{...}' into a Block
+    :param state: block state string
+    :return Block:
+    """
+    block_name, bracket, rest = state.partition("[")
+    if not bracket:
+        block_name, brace, data = state.partition("{")
+        return Block(block_name, data=brace + data if brace else None)
+    properties, _, data = rest.partition("]")
+    states = dict(prop.split("=", 1) for prop in properties.split(",") if "=" in prop)
+    return Block(block_name, states, data=data if data else None)
+
+
+def is_water(state):
+    # Water itself or any waterlogged block
+    return "water" in state.split("[", 1)[0] or "waterlogged=true" in state
+
+
+def water_mask(world_slice, heightmap):
+    """
+    Builds a full resolution water map: 1 where the top block of a column is water, 0 otherwise
+    :param world_slice: loaded gdpc WorldSlice
+    :param heightmap: heightmap array of the slice, indexed [x, z]
+    :return numpy array: same shape and dtype as heightmap
+    """
+    palette, ids = surface_states(world_slice, heightmap)
+    # Extra trailing False so that the -1 (not loaded) ids map to dry land
+    water = np.array([is_water(state) for state in palette] + [False])
+    return water[ids].astype(np.asarray(heightmap).dtype)
+
+
+def block_volume(world_slice, begin, end):
+    """
+    Reads every block state in a box of the world in one pass over the WorldSlice
+    :param world_slice: loaded gdpc WorldSlice
+    :param begin: lowest corner of the box, global coordinates
+    :param end: corner opposite to begin, exclusive
+    :return tuple: (palette, ids) where ids is indexed [x, y, z] relative to begin and holds -1 where
+        the box is outside the loaded sections
+    """
+    begin = np.array([begin[0], begin[1], begin[2]])
+    size = np.array([end[0], end[1], end[2]]) - begin
+    ids = np.full(tuple(size), -1, dtype=np.int32)
+    palette = []
+    palette_ids = {}
+
+    for section in iter_sections(world_slice):
+        # Overlap of the section with the box, relative to the section and to the box
+        origin = np.array((section.x, section.y, section.z)) * 16 - begin
+        low = np.maximum(origin, 0)
+        high = np.minimum(origin + 16, size)
+        if (low >= high).any():
+            continue
+        sx, sy, sz = (slice(a - o, b - o) for a, b, o in zip(low, high, origin))
+
+        mapping = palette_mapping(section.states, palette, palette_ids)
+        ids[low[0]:high[0], low[1]:high[1], low[2]:high[2]] = mapping[section.indices[sy, sz, sx].transpose(2, 0, 1)]
+
+    return palette, ids
+
+
+def block_entity_positions(world_slice):
+    """
+    Lists the global positions of all block entities (chests, signs, ...) in a WorldSlice
+    :param world_slice: loaded gdpc WorldSlice
+    :return list: (x, y, z) tuples
+    """
+    if hasattr(world_slice, "block_entity_positions"):
+        return world_slice.block_entity_positions()
+
+    positions = []
+    for chunk_tag in world_slice.nbt["Chunks"]:
+        if "block_entities" in chunk_tag:
+            for tag in chunk_tag["block_entities"]:
+                positions.append((int(tag["x"].value), int(tag["y"].value), int(tag["z"].value)))
+    return positions
+
+
+class TerrainLayers:
+    """The per-column layers of an area the generator works with, without the block data behind them"""
+
+    def __init__(self, rect, heightmaps, surface_palette, surface_ids, water, biome_palette, biome_ids):
+        self.rect = rect
+        self.heightmaps = heightmaps  # dict from heightmap type to array indexed [x, z]
+        self.surface_palette = surface_palette
+        self.surface_ids = surface_ids  # palette index of the top block of every column, -1 if not loaded
+        self.water = water  # 1 where the top block is water, 0 otherwise
+        self.biome_palette = biome_palette
+        self.biome_ids = biome_ids  # palette index of the biome at the top block, -1 if not loaded
+
+
+def slice_layers(world_slice, heightmap_types=("MOTION_BLOCKING_NO_LEAVES", "WORLD_SURFACE"),
+                 surface_heightmap="MOTION_BLOCKING_NO_LEAVES"):
+    """
+    Extracts the layers of an already loaded WorldSlice, the same layers stream_layers gives
+    :param world_slice: loaded gdpc WorldSlice
+    :param heightmap_types: heightmaps to keep
+    :param surface_heightmap: heightmap whose top blocks give the surface, water and biome layers
+    :return TerrainLayers:
+    """
+    heightmaps = {name: np.asarray(world_slice.heightmaps[name], dtype=np.int64) for name in heightmap_types}
+    heightmap = world_slice.heightmaps[surface_heightmap]
+    surface_palette, surface_ids = surface_states(world_slice, heightmap)
+    biome_palette, biome_ids = surface_biomes(world_slice, heightmap)
+    water = water_mask(world_slice, heightmap).astype(np.int64)
+    return TerrainLayers(world_slice.rect, heightmaps, surface_palette, surface_ids, water, biome_palette, biome_ids)
+
+
+def chunk_tiles(rect, tile_chunks):
+    """
+    Splits a rect into tiles along chunk borders
+    :param rect: gdpc Rect to split
+    :param tile_chunks: side length of a tile in chunks
+    :return list: Rects covering rect, each within one tile_chunks x tile_chunks group of chunks
+    """
+    tile_size = tile_chunks * 16
+    tiles = []
+    first_x = rect.offset.x - rect.offset.x % tile_size
+    first_z = rect.offset.y - rect.offset.y % tile_size
+    for x in range(first_x, rect.end.x, tile_size):
+        for z in range(first_z, rect.end.y, tile_size):
+            begin_x, begin_z = max(x, rect.offset.x), max(z, rect.offset.y)
+            end_x, end_z = min(x + tile_size, rect.end.x), min(z + tile_size, rect.end.y)
+            tiles.append(Rect((begin_x, begin_z), (end_x - begin_x, end_z - begin_z)))
+    return tiles
+
+
+def stream_layers(editor, rect, tile_chunks=8, heightmap_types=("MOTION_BLOCKING_NO_LEAVES", "WORLD_SURFACE"),
+                  surface_heightmap="MOTION_BLOCKING_NO_LEAVES", surface=True):
+    """
+    Loads the layers of an area one chunk aligned tile at a time. Each tile's WorldSlice is dropped as
+    soon as its layers are copied out, so peak memory is the layers plus one tile, whatever the area size
+    :param editor: editor instance
+    :param rect: gdpc Rect of the area, usually buildArea.toRect()
+    :param tile_chunks: side length of a tile in chunks
+    :param heightmap_types: heightmaps to keep
+    :param surface_heightmap: heightmap whose top blocks give the surface, water and biome layers
+    :param surface: also extract the surface, water and biome layers, only heightmaps otherwise
+    :return TerrainLayers: the layers are None when surface is False
+    """
+    shape = (rect.size.x, rect.size.y)
+    types = tuple(dict.fromkeys(heightmap_types + ((surface_heightmap,) if surface else ())))
+    heightmaps = {name: np.zeros(shape, dtype=np.int64) for name in heightmap_types}
+    surface_ids = np.full(shape, -1, dtype=np.int32) if surface else None
+    biome_ids = np.full(shape, -1, dtype=np.int32) if surface else None
+    surface_palette, surface_palette_ids = [], {}
+    biome_palette, biome_palette_ids = [], {}
+
+    for tile in chunk_tiles(rect, tile_chunks):
+        world_slice = editor.loadWorldSlice(tile, heightmapTypes=types)
+        window = (slice(tile.offset.x - rect.offset.x, tile.end.x - rect.offset.x),
+                  slice(tile.offset.y - rect.offset.y, tile.end.y - rect.offset.y))
+        for name in heightmap_types:
+            heightmaps[name][window] = world_slice.heightmaps[name]
+
+        if surface:
+            # Tile palettes are merged into one palette for the whole area
+            heightmap = world_slice.heightmaps[surface_heightmap]
+            for palette, palette_ids, ids, layer in ((surface_palette, surface_palette_ids, surface_ids,
+                                                      surface_states(world_slice, heightmap)),
+                                                     (biome_palette, biome_palette_ids, biome_ids,
+                                                      surface_biomes(world_slice, heightmap))):
+                tile_palette, tile_ids = layer
+                # Extra trailing -1 so that the -1 (not loaded) ids stay -1
+                mapping = np.append(palette_mapping(tile_palette, palette, palette_ids), np.int32(-1))
+                ids[window] = mapping[tile_ids]
+
+        # Only the extracted layers outlive the tile
+        del world_slice
+
+    water = None
+    if surface:
+        # Same rule as water_mask, columns that were not loaded count as dry land
+        water_lookup = np.array([is_water(state) for state in surface_palette] + [False])
+        water = water_lookup[surface_ids].astype(np.int64)
+
+    return TerrainLayers(rect, heightmaps, surface_palette, surface_ids, water, biome_palette, biome_ids)
@@ -0,0 +1,276 @@
+"""
+Write diffing: placements that would not change the world are dropped before they are sent.
+
+WriteDiffer wraps an editor and checks every placement against what is known about each position:
+the block written there earlier in the run, or else the block in the world when the run started,
+read from a loaded WorldSlice or, without one, from the surface layer of TerrainLayers. Placements
+of the block that is already there are counted and dropped, the rest are passed on in order.
+
+Fill and setblock commands are diffed too. A command line that sets a box to a known block updates
+what is known, lines that only change part of a box (replace filters, keep, hollow) mark the box as
+unknown. Any other command could change anything, so after it only later writes are trusted.
+"""
+
+import re
+
+import numpy as np
+from gdpc.block import transformedBlockOrPalette
+
+from placement_pipeline import is_single_position
+
+SECTION = 16
+# Values stored per position: palette index of the block known to be there, or one of these
+UNKNOWN = -1  # nothing written, the world as loaded is used
+DIRTY = -2  # changed in a way that is not tracked, never diffed
+
+FILL = re.compile(r"^/?fill\s+(-?\d+)\s+(-?\d+)\s+(-?\d+)\s+(-?\d+)\s+(-?\d+)\s+(-?\d+)\s+"
+                  r"(\S+?(?:\[[^\]]*\])?(?:\{.*\})?)(?:\s+(\w+)(\s+.*)?)?\s*$")
+SETBLOCK = re.compile(r"^/?setblock\s+(-?\d+)\s+(-?\d+)\s+(-?\d+)\s+"
+                      r"(\S+?(?:\[[^\]]*\])?(?:\{.*\})?)(?:\s+(\w+))?\s*$")
+
+
+def state_key(state):
+    """
+    Canonical form of a block state string, so equal blocks compare equal
+    :param state: block state string like 'oak_stairs[half=top,facing=north]{...}'
+    :return String: namespaced id, states sorted by name, then the data
+    """
+    match = re.match(r"([^\[{]*)(?:\[([^\]]*)\])?(.*)$", state, re.DOTALL)
+    block_name, states, data = match.groups()
+    if ":" not in block_name:
+        block_name = "minecraft:" + block_name
+    if states:
+        return f"{block_name}[{','.join(sorted(states.split(',')))}]{data}"
+    return block_name + data
+
+
+class VoxelSections:
+    """Sparse 3D int32 grid stored as 16x16x16 numpy sections, allocated when first written"""
+
+    def __init__(self, default=UNKNOWN):
+        self.default = default
+        self.sections = {}
+
+    def get(self, x, y, z):
+        section = self.sections.get((x >> 4, y >> 4, z >> 4))
+        return self.default if section is None else int(section[x & 15, y & 15, z & 15])
+
+    def set(self, x, y, z, value):
+        self.section(x >> 4, y >> 4, z >> 4)[x & 15, y & 15, z & 15] = value
+
+    def fill(self, begin, end, value):
+        # Sets every position of the box from begin to end, end exclusive
+        for key, window in self.windows(begin, end):
+            self.section(*key)[window] = value
+
+    def box(self, begin, end):
+        # Dense copy of the box from begin to end, end exclusive
+        values = np.full([high - low for low, high in zip(begin, end)], self.default, dtype=np.int32)
+        for (sx, sy, sz), (xs, ys, zs) in self.windows(begin, end):
+            section = self.sections.get((sx, sy, sz))
+            if section is not None:
+                values[sx * SECTION + xs.start - begin[0]: sx * SECTION + xs.stop - begin[0],
+                       sy * SECTION + ys.start - begin[1]: sy * SECTION + ys.stop - begin[1],
+                       sz * SECTION + zs.start - begin[2]: sz * SECTION + zs.stop - begin[2]] = section[xs, ys, zs]
+        return values
+
+    def items(self):
+        # (x, y, z, value) of every position not holding the default, in section order
+        for (sx, sy, sz), section in self.sections.items():
+            for i, j, k in np.argwhere(section != self.default).tolist():
+                yield sx * SECTION + i, sy * SECTION + j, sz * SECTION + k, int(section[i, j, k])
+
+    def clear(self):
+        self.sections = {}
+
+    def section(self, sx, sy, sz):
+        section = self.sections.get((sx, sy, sz))
+        if section is None:
+            section = np.full((SECTION, SECTION, SECTION), self.default, dtype=np.int32)
+            self.sections[sx, sy, sz] = section
+        return section
+
+    @staticmethod
+    def windows(begin, end):
+        # Section keys overlapped by a box and the slice of each section inside it
+        for sx in range(begin[0] >> 4, (end[0] - 1 >> 4) + 1):
+            xs = slice(max(begin[0] - sx * SECTION, 0), min(end[0] - sx * SECTION, SECTION))
+            for sy in range(begin[1] >> 4, (end[1] - 1 >> 4) + 1):
+                ys = slice(max(begin[1] - sy * SECTION, 0), min(end[1] - sy * SECTION, SECTION))
+                for sz in range(begin[2] >> 4, (end[2] - 1 >> 4) + 1):
+                    zs = slice(max(begin[2] - sz * SECTION, 0), min(end[2] - sz * SECTION, SECTION))
+                    yield (sx, sy, sz), (xs, ys, zs)
+
+
+class WriteDiffer:
+    """Editor wrapper that drops placements of blocks the world already holds"""
+
+    def __init__(self, editor, world_slice=None, layers=None, surface_heightmap="MOTION_BLOCKING_NO_LEAVES"):
+        """
+        :param editor: editor (or PlacementPipeline) the remaining placements are sent to
+        :param world_slice: WorldSlice loaded before any writes, placements are compared against it
+        :param layers: TerrainLayers used instead when no world slice is loaded, only top blocks are known
+        :param surface_heightmap: heightmap the surface layer of layers was read at
+        """
+        self.editor = editor
+        self.world_slice = world_slice
+        self.layers = layers
+        self.surface_heightmap = surface_heightmap
+        self.known = VoxelSections()
+        self.palette = []
+        self.palette_ids = {}
+        # Cleared by commands that are not understood, the loaded world can no longer be trusted after them
+        self.world_valid = world_slice is not None or layers is not None
+
+        # Statistics: blocks asked for, dropped because the world held them or an earlier write made them
+        self.placements = 0
+        self.unchanged = 0
+        self.duplicates = 0
+        self.command_lines = 0
+        self.commands_dropped = 0
+
+    @property
+    def transform(self):
+        # gdpc geometry functions read the transform before placing
+        return self.editor.transform
+
+    def placeBlock(self, position, block, replace=None):
+        single = is_single_position(position)
+        positions = [position] if single else list(position)
+        global_block = transformedBlockOrPalette(block, self.transform.rotation, self.transform.flip)
+        kept = self._diff([self.transform * local for local in positions], global_block, replace)
+        if not kept:
+            return True
+        return self.editor.placeBlock(position if single else [positions[i] for i in kept], block, replace)
+
+    def placeBlockGlobal(self, position, block, replace=None):
+        single = is_single_position(position)
+        positions = [position] if single else list(position)
+        kept = self._diff(positions, block, replace)
+        if not kept:
+            return True
+        return self.editor.placeBlockGlobal(position if single else [positions[i] for i in kept], block, replace)
+
+    def runCommand(self, command, position=None, syncWithBuffer=False):
+        lines = []
+        for line in command.split("\n"):
+            self.command_lines += 1
+            if self._diff_command(line.strip()):
+                lines.append(line)
+            else:
+                self.commands_dropped += 1
+        if lines:
+            return self.editor.runCommand("\n".join(lines), position, syncWithBuffer)
+
+    def __getattr__(self, name):
+        # Everything else (flushBuffer, reads, ...) goes straight to the editor
+        if name.startswith("_") or name == "editor":
+            raise AttributeError(name)
+        return getattr(self.editor, name)
+
+    def _diff(self, positions, block, replace):
+        """
+        Updates what is known about positions and returns the indices of those that still need the block
+        :param positions: global positions
+        :param block: Block, or a sequence of blocks to sample from
+        :param replace: block filter of the placement
+        :return list: indices into positions
+        """
+        self.placements += len(positions)
+        # Random palettes and filtered placements leave the position unpredictable
+        if replace is not None or not hasattr(block, "id"):
+            for x, y, z in positions:
+                self.known.set(x, y, z, DIRTY)
+            return list(range(len(positions)))
+
+        value = self._palette_id(state_key(str(block)))
+        kept = []
+        for index, (x, y, z) in enumerate(positions):
+            x, y, z = int(x), int(y), int(z)
+            known = self.known.get(x, y, z)
+            if known == value:
+                self.duplicates += 1
+                continue
+            if known == UNKNOWN and self._world_key(x, y, z) == self.palette[value]:
+                self.unchanged += 1
+                self.known.set(x, y, z, value)
+                continue
+            self.known.set(x, y, z, value)
+            kept.append(index)
+        return kept
+
+    def _diff_command(self, line):
+        # Updates what is known for one command line, False when it would change nothing
+        match = FILL.match(line)
+        if match is not None:
+            coordinates = [int(value) for value in match.group(1, 2, 3, 4, 5, 6)]
+            begin = [min(coordinates[i], coordinates[i + 3]) for i in range(3)]
+            end = [max(coordinates[i], coordinates[i + 3]) + 1 for i in range(3)]
+            mode, rest = match.group(8), match.group(9)
+            if mode in (None, "destroy") or (mode == "replace" and not rest):
+                value = self._palette_id(state_key(match.group(7)))
+                unchanged = self._box_unchanged(begin, end, value)
+                self.known.fill(begin, end, value)
+                return not unchanged
+            self.known.fill(begin, end, DIRTY)
+            return True
+
+        match = SETBLOCK.match(line)
+        if match is not None:
+            x, y, z = (int(value) for value in match.group(1, 2, 3))
+            if match.group(5) in (None, "replace", "destroy"):
+                value = self._palette_id(state_key(match.group(4)))
+                unchanged = self._box_unchanged((x, y, z), (x + 1, y + 1, z + 1), value)
+                self.known.set(x, y, z, value)
+                return not unchanged
+            self.known.set(x, y, z, DIRTY)
+            return True
+
+        # Unknown commands may have changed any block
+        if line:
+            self.known.clear()
+            self.world_valid = False
+        return True
+
+    def _box_unchanged(self, begin, end, value):
+        # Whether every position of the box already holds the block, from earlier writes or the world
+        known = self.known.box(begin, end)
+        if ((known != value) & (known != UNKNOWN)).any():
+            return False
+        key = self.palette[value]
+        # Stops at the first block that differs, which for most boxes is the first one
+        for i, j, k in np.argwhere(known == UNKNOWN).tolist():
+            if self._world_key(begin[0] + i, begin[1] + j, begin[2] + k) != key:
+                return False
+        return True
+
+    def _palette_id(self, key):
+        value = self.palette_ids.get(key)
+        if value is None:
+            value = self.palette_ids[key] = len(self.palette)
+            self.palette.append(key)
+        return value
+
+    def _world_key(self, x, y, z):
+        # Key of the block the world held before the run, None where it is not known
+        if not self.world_valid:
+            return None
+        if self.world_slice is not None:
+            box = self.world_slice.box
+            if not box.contains((x, y, z)):
+                return None
+            return state_key(str(self.world_slice.getBlockGlobal((x, y, z))))
+        rect = self.layers.rect
+        i, k = x - rect.offset.x, z - rect.offset.y
+        if not (0 <= i < rect.size.x and 0 <= k < rect.size.y):
+            return None
+        # Only the top block of every column is in the layers
+        if y != self.layers.heightmaps[self.surface_heightmap][i, k] - 1 or self.layers.surface_ids[i, k] < 0:
+            return None
+        return state_key(self.layers.surface_palette[self.layers.surface_ids[i, k]])
+
+    def statistics(self):
+        # Summary of the writes that were dropped, for printing at the end of a run
+        return {"placements": self.placements, "unchanged": self.unchanged, "duplicates": self.duplicates,
+                "eliminated": self.unchanged + self.duplicates, "command_lines": self.command_lines,
+                "commands_dropped": self.commands_dropped}